@@ -0,0 +1,214 @@
+"""Shared Anthropic clients, with optional record/replay of API traffic.
+
+get_client(api_key) returns one client per API key and process, so its
+HTTP connection pool is reused across requests instead of being rebuilt
+(TLS handshake included) on every call.
+
+Set ANTHROPIC_CASSETTE_MODE to route every client through a cassette:
+
+    record  forward requests to the API and save each response under a
+            digest of the request (method, path, canonical JSON body)
+    replay  answer from the cassette only, instantly; a request that was
+            never recorded fails with a 400 naming its digest
+
+The cassette (ANTHROPIC_CASSETTE_PATH, default cassettes/anthropic.sqlite3)
+is a SQLite file of zlib-compressed response bodies, safe to record into
+from several gunicorn workers at once. API keys are not part of the digest
+and are never written to it, so a cassette recorded with one key replays
+with any key.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import anthropic
+import httpx
+
+CASSETTE_MODES = ('off', 'record', 'replay')
+DEFAULT_CASSETTE_PATH = os.path.join('cassettes', 'anthropic.sqlite3')
+
+# Response headers worth keeping; everything else (dates, ids, cookies) is dropped
+_KEPT_HEADERS = ('content-type', 'retry-after', 'anthropic-ratelimit-requests-remaining',
+                 'anthropic-ratelimit-tokens-remaining')
+
+
+def request_digest(request):
+    """Stable digest of what the API sees, ignoring headers such as the API key"""
+    body = request.content or b''
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode()
+    except ValueError:
+        pass
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(b' ')
+    digest.update(request.url.raw_path)
+    digest.update(b'\n')
+    digest.update(body)
+    return digest.hexdigest()
+
+
+class Cassette:
+    """SQLite-backed store of request digest -> recorded response"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                digest TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                recorded_at REAL NOT NULL
+            )""")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, digest):
+        row = self._connect().execute(
+            'SELECT status, headers, body FROM responses WHERE digest = ?', (digest,)
+        ).fetchone()
+        if row is None:
+            return None
+        status, headers, body = row
+        return status, json.loads(headers), zlib.decompress(body)
+
+    def put(self, digest, path, status, headers, body):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO responses (digest, path, status, headers, body, recorded_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (digest, path, status, json.dumps(headers), zlib.compress(body, 9), time.time())
+        )
+
+    def __len__(self):
+        return self._connect().execute('SELECT count(*) FROM responses').fetchone()[0]
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """httpx transport that records API responses to, or replays them from, a Cassette"""
+
+    def __init__(self, cassette, mode, inner=None):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unsupported cassette mode: {mode}')
+        self.cassette = cassette
+        self.mode = mode
+        self.inner = inner or httpx.HTTPTransport()
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+
+    def handle_request(self, request):
+        request.read()
+        digest = request_digest(request)
+
+        if self.mode == 'replay':
+            recorded = self.cassette.get(digest)
+            if recorded is None:
+                self.misses += 1
+                error = {'type': 'error', 'error': {
+                    'type': 'invalid_request_error',
+                    'message': f'No recorded response for request {digest[:16]} in {self.cassette.path}'
+                }}
+                return httpx.Response(400, json=error, request=request)
+            self.hits += 1
+            status, headers, body = recorded
+            return httpx.Response(status, headers=headers, content=body, request=request)
+
+        response = self.inner.handle_request(request)
+        body = response.read()
+        response.close()
+        headers = {name: value for name, value in response.headers.items() if name.lower() in _KEPT_HEADERS}
+        if response.status_code < 500 and response.status_code != 429:
+            # Transient failures are not worth replaying
+            self.cassette.put(digest, request.url.path, response.status_code, headers, body)
+            self.recorded += 1
+        return httpx.Response(response.status_code, headers=headers, content=body, request=request)
+
+    def close(self):
+        self.inner.close()
+
+    def stats(self):
+        return {'mode': self.mode, 'hits': self.hits, 'misses': self.misses, 'recorded': self.recorded}
+
+
+class ClientRegistry:
+    """One Anthropic client per API key and process, least recently used evicted first"""
+
+    def __init__(self, max_clients=256, cassette_mode=None, cassette_path=None):
+        self.max_clients = max_clients
+        self.cassette_mode = cassette_mode or os.environ.get('ANTHROPIC_CASSETTE_MODE', 'off')
+        if self.cassette_mode not in CASSETTE_MODES:
+            raise ValueError(f"ANTHROPIC_CASSETTE_MODE must be one of {', '.join(CASSETTE_MODES)}")
+        self.cassette_path = cassette_path or os.environ.get('ANTHROPIC_CASSETTE_PATH', DEFAULT_CASSETTE_PATH)
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()
+        self._pid = None
+        self._transport = None
+        self.created = 0
+
+    def _reset_if_forked(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # Connection pools must not be shared with the parent process
+            self._clients = OrderedDict()
+            self._transport = None
+            self._pid = pid
+
+    def _new_client(self, api_key):
+        options = {}
+        if self.cassette_mode != 'off':
+            if self._transport is None:
+                self._transport = CassetteTransport(Cassette(self.cassette_path), self.cassette_mode)
+            options['http_client'] = httpx.Client(transport=self._transport, timeout=httpx.Timeout(600, connect=5))
+            if self.cassette_mode == 'replay':
+                options['max_retries'] = 0
+                api_key = api_key or 'replay'
+        self.created += 1
+        return anthropic.Anthropic(api_key=api_key, **options)
+
+    def get(self, api_key=None):
+        """Client for api_key (None: the ANTHROPIC_API_KEY environment variable)"""
+        key = hashlib.sha256(api_key.encode()).hexdigest() if api_key else None
+        with self._lock:
+            self._reset_if_forked()
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+            client = self._new_client(api_key)
+            self._clients[key] = client
+            if len(self._clients) > self.max_clients:
+                # Not closed here: another thread may still be streaming through it. Its own
+                # http client closes the connection pool once the last reference is dropped.
+                self._clients.popitem(last=False)
+            return client
+
+    def stats(self):
+        stats = {'clients': len(self._clients), 'created': self.created, 'cassette_mode': self.cassette_mode}
+        if self._transport is not None:
+            stats['cassette'] = self._transport.stats()
+        return stats
+
+
+clients = ClientRegistry()
+
+
+def get_client(api_key=None):
+    return clients.get(api_key)
@@ -11,13 +11,29 @@ from pypdf import PdfReader
 import io
 import base64
 from datetime import datetime, timedelta
-import redis
 import json
+import logging
+import math
 import uuid
 import hashlib
 import tempfile
+from redis_pool import RedisPool
+from anthropic_clients import clients as anthropic_clients, get_client
+from write_behind import WriteBehindQueue
+from evaluation_parser import parse_judge_output, display_evaluation
+from metrics import init_metrics, span
+from query_metrics import init_query_metrics
+from upstream_limiter import UpstreamLimiter, UpstreamBusy
+from memory_budget import monitor as memory, mapping_size
+from health import DependencyProber, database_check, redis_check, db_pool_stats, init_health
+from profiling import init_profiling
+from structured_logging import configure_logging, init_request_logging
+from model_usage import create_message, request_model_calls, TOKEN_KINDS
+from sqlalchemy.exc import IntegrityError
 
 load_dotenv()
+configure_logging()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
@@ -47,15 +63,18 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=1)
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 Session(app)  # Initialize Flask-Session
+init_metrics(app)  # Request/stage timings at /metrics; after Session() so session load is timed
+init_request_logging(app)  # Request ids and one sampled JSON summary line per request
+init_profiling(app)  # No-op unless PROFILE_SECRET or PROFILE_SAMPLE_RATE is set
+init_query_metrics(app, db)  # Statement timings, slow-query log and per-request query counts
 
 # Redis configuration (optional, fallback to in-memory if not available)
-try:
-    redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379')
-    redis_client = redis.from_url(redis_url)
-    redis_client.ping()
-except:
-    redis_client = None
-    print("Redis not available, using in-memory storage")
+# The pool connects lazily in each worker with short timeouts; a circuit breaker
+# skips Redis for a cool-down period after repeated failures.
+redis_pool = RedisPool.from_env()
+
+# Model calls are paced per API key (token bucket + adaptive concurrency), shared across workers via Redis
+upstream = UpstreamLimiter.from_env(redis_pool)
 
 # PDF storage - use Redis if available, otherwise in-memory
 # This ensures it works on Render with multiple workers
@@ -63,29 +82,21 @@ pdf_storage = {}
 
 def store_pdf(session_id, content):
     """Store PDF content using Redis if available, otherwise in-memory"""
-    if redis_client:
-        try:
-            redis_client.setex(f"pdf:{session_id}", 3600, content)  # Expire after 1 hour
-            return True
-        except:
-            pass
+    if redis_pool.run(lambda r: r.setex(f"pdf:{session_id}", 3600, content)):  # Expire after 1 hour
+        return True
     # Fallback to in-memory storage
     pdf_storage[session_id] = content
     return True
 
 def get_pdf(session_id):
     """Get PDF content from Redis if available, otherwise from in-memory"""
-    if redis_client:
-        try:
-            content = redis_client.get(f"pdf:{session_id}")
-            if content:
-                return content.decode('utf-8') if isinstance(content, bytes) else content
-        except:
-            pass
+    content = redis_pool.run(lambda r: r.get(f"pdf:{session_id}"))
+    if content:
+        return content.decode('utf-8') if isinstance(content, bytes) else content
     # Fallback to in-memory storage
     return pdf_storage.get(session_id, '')
 
-# Database Models (for future use)
+# Database Models
 class ChatSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(100), unique=True, nullable=False)
@@ -109,6 +120,131 @@ class Evaluation(db.Model):
     groundedness_level = db.Column(db.String(50))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+class ModelCall(db.Model):
+    """One model API call with its token usage, estimated cost and latency"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False, index=True)
+    user_key = db.Column(db.String(16), index=True)  # Fingerprint of the caller's API key
+    document_hash = db.Column(db.String(16))
+    stage = db.Column(db.String(20), nullable=False)  # 'answer', 'judge', 'improve'
+    criterion = db.Column(db.String(100))
+    model = db.Column(db.String(100), nullable=False)
+    input_tokens = db.Column(db.Integer, nullable=False, default=0)
+    output_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cache_write_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cache_read_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cost_usd = db.Column(db.Float, nullable=False, default=0)
+    latency_ms = db.Column(db.Float)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+def key_fingerprint(api_key):
+    """Short, non-reversible id for an API key, used to group usage per user"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16] if api_key else None
+
+def document_hash(content):
+    return hashlib.sha256(content.encode()).hexdigest()[:16] if content else None
+
+def parse_label(evaluation_text):
+    """Pull the label out of a judge response (JSON or 'Label:' text), if present"""
+    label, _ = parse_judge_output(evaluation_text)
+    return label or None
+
+_tables_created = False
+
+def persist_chat_turns(turns):
+    """Write a batch of queued chat turns (sessions, messages, evaluations) in one transaction"""
+    global _tables_created
+    with app.app_context():
+        if not _tables_created:
+            db.create_all()
+            _tables_created = True
+        for attempt in range(2):
+            try:
+                session_ids = {turn['session_id'] for turn in turns}
+                session_pks = dict(
+                    db.session.query(ChatSession.session_id, ChatSession.id)
+                    .filter(ChatSession.session_id.in_(session_ids))
+                )
+                new_sessions = {}
+                for turn in turns:
+                    if turn['session_id'] not in session_pks:
+                        new_sessions.setdefault(turn['session_id'], turn['timestamp'])
+                if new_sessions:
+                    db.session.execute(db.insert(ChatSession), [
+                        {'session_id': sid, 'created_at': created_at}
+                        for sid, created_at in new_sessions.items()
+                    ])
+                    session_pks.update(
+                        db.session.query(ChatSession.session_id, ChatSession.id)
+                        .filter(ChatSession.session_id.in_(new_sessions))
+                    )
+                
+                messages = []
+                evaluations = []
+                model_calls = []
+                for turn in turns:
+                    pk = session_pks[turn['session_id']]
+                    for call in turn.get('model_calls', []):
+                        model_calls.append(dict(call, session_id=pk, timestamp=turn['timestamp']))
+                    for role, content in turn['messages']:
+                        messages.append({
+                            'session_id': pk,
+                            'role': role,
+                            'content': content,
+                            'timestamp': turn['timestamp']
+                        })
+                    for item in turn['evaluations']:
+                        evaluations.append(dict(item, session_id=pk, timestamp=turn['timestamp']))
+                
+                if messages:
+                    db.session.execute(db.insert(Message), messages)
+                if evaluations:
+                    db.session.execute(db.insert(Evaluation), evaluations)
+                if model_calls:
+                    db.session.execute(db.insert(ModelCall), model_calls)
+                with span('db_commit', route='write_behind'):
+                    db.session.commit()
+                return
+            except IntegrityError:
+                # Another worker created one of the sessions first; retry with fresh ids
+                db.session.rollback()
+                if attempt:
+                    raise
+            finally:
+                db.session.remove()
+
+# Conversations are persisted off the request path: chat() and improve_response()
+# enqueue a turn and the write-behind thread batches the inserts.
+chat_persistence = WriteBehindQueue(
+    persist_chat_turns,
+    batch_size=int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 50)),
+    flush_interval=float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', 2.0)),
+    max_attempts=int(os.environ.get('WRITE_BEHIND_MAX_ATTEMPTS', 3))
+)
+
+def record_turn(question, answer, evaluations, user_key=None, document=None, include_question=True):
+    """Queue one question/answer pair, its evaluations and the request's model calls for persistence.
+
+    Pass include_question=False when `answer` revises an earlier answer to a
+    question that is already stored, so only the new assistant message is added.
+    """
+    if 'session_id' not in session:
+        session['session_id'] = str(uuid.uuid4())
+    doc_hash = document_hash(document)
+    messages = [('user', question), ('assistant', answer)] if include_question else [('assistant', answer)]
+    chat_persistence.put({
+        'session_id': session['session_id'],
+        'timestamp': datetime.utcnow(),
+        'messages': messages,
+        'model_calls': [dict(call, user_key=user_key, document_hash=doc_hash) for call in request_model_calls()],
+        'evaluations': [{
+            'question': question,
+            'response': answer,
+            'evaluation_result': item['evaluation'],
+            'groundedness_level': parse_label(item['evaluation']) if item['type'] == 'groundedness' else None
+        } for item in evaluations]
+    })
+
 GROUNDEDNESS_PROMPT = """You are evaluating whether an AI response is grounded in the provided document context.
 
 Document Context:
@@ -120,13 +256,8 @@ User Question:
 AI Response:
 {response}
 
-Evaluate the response and provide:
-1. A label: "Grounded", "Partially Grounded", or "Not Grounded"
-2. A brief explanation (2-3 sentences) of your evaluation
-
-Format your response as:
-Label: [your label]
-Explanation: [your explanation]"""
+Evaluate the response and reply with only a JSON object, no other text:
+{{"label": "Grounded" | "Partially Grounded" | "Not Grounded", "explanation": "<2-3 sentences>"}}"""
 
 @app.route('/')
 def index():
@@ -167,7 +298,7 @@ def validate_api_key():
             return jsonify({'valid': False, 'error': 'No API key provided'}), 400
         
         # Test the API key with a minimal request
-        test_client = anthropic.Anthropic(api_key=api_key)
+        test_client = get_client(api_key)
         test_client.messages.create(
             model="claude-3-haiku-20240307",
             max_tokens=10,
@@ -181,34 +312,60 @@ def validate_api_key():
     except Exception as e:
         return jsonify({'valid': False, 'error': str(e)}), 400
 
+# Dependencies are probed from a background thread; health routes only read the cached results
+dependency_prober = DependencyProber.from_env({
+    'database': (database_check(app, db), True),
+    'redis': (redis_check(redis_pool), False)  # Optional: PDFs fall back to in-process storage
+})
+
+def connection_pools():
+    return {
+        'database': db_pool_stats(db.engine),
+        'redis': redis_pool.pool_stats(),
+        'redis_breaker': redis_pool.breaker.to_dict(),
+        'write_behind': chat_persistence.stats()
+    }
+
+init_health(app, dependency_prober, connection_pools)  # /healthz and /readyz
+
+# Sizes reported at /metrics and logged when a worker is recycled for exceeding MEMORY_BUDGET_MB
+memory.track('pdf_storage', lambda: mapping_size(pdf_storage))
+memory.track('anthropic_clients', lambda: {'items': anthropic_clients.stats()['clients']})
+memory.track('write_behind', lambda: {'items': chat_persistence.stats()['pending']})
+
 @app.route('/health')
 def health_check():
     """Health check endpoint for Render monitoring"""
-    try:
-        # Check database connection
-        db.session.execute('SELECT 1')
-        db_status = 'healthy'
-    except:
-        db_status = 'unhealthy'
-    
-    # Check Redis connection if available
-    redis_status = 'not configured'
-    if redis_client:
-        try:
-            redis_client.ping()
-            redis_status = 'healthy'
-        except:
-            redis_status = 'unhealthy'
+    _, checks = dependency_prober.snapshot()
+    redis_check_result = checks['redis']
+    if redis_pool.breaker.state == 'open':
+        redis_status = 'circuit open'
+    elif redis_check_result['ok']:
+        redis_status = redis_check_result.get('detail', 'healthy')
+    else:
+        redis_status = 'unhealthy'
     
     return jsonify({
         'status': 'healthy',
-        'database': db_status,
+        'database': 'healthy' if checks['database']['ok'] else 'unhealthy',
         'redis': redis_status,
+        'redis_breaker': redis_pool.breaker.to_dict(),
+        'redis_pool': redis_pool.pool_stats(),
+        'db_pool': db_pool_stats(db.engine),
+        'write_behind': chat_persistence.stats(),
+        'anthropic_clients': anthropic_clients.stats(),
+        'memory': memory.snapshot(),
         'timestamp': datetime.utcnow().isoformat(),
         'version': '2.1.2',  # Force Render redeploy - fix UI deployment
         'deployment_id': 'ui-update-' + str(int(datetime.utcnow().timestamp()))
     })
 
+def upstream_busy_response(error):
+    """429 with Retry-After for a model call the limiter could not schedule in time"""
+    retry_after = max(int(math.ceil(error.retry_after)), 1)
+    return jsonify({'error': f'{error}. Please retry in {retry_after} seconds.', 'retry_after': retry_after}), \
+        429, {'Retry-After': str(retry_after)}
+
 @app.route('/chat', methods=['POST'])
 def chat():
     try:
@@ -223,13 +380,14 @@ def chat():
         
         # Create Anthropic client with user's API key
         try:
-            client = anthropic.Anthropic(api_key=api_key)
+            client = get_client(api_key)
         except Exception as e:
             return jsonify({'error': f'Invalid API key: {str(e)}'}), 401
         
         # Get PDF content from session (now handled server-side by Flask-Session)
-        pdf_content = session.get('pdf_content', '')
-        print(f"DEBUG CHAT: PDF content length: {len(pdf_content)}")
+        with span('pdf_lookup'):
+            pdf_content = session.get('pdf_content', '')
+        logger.debug('PDF loaded from session', extra={'pdf_chars': len(pdf_content)})
         
         messages = []
         if pdf_content:
@@ -261,7 +419,9 @@ User question: {user_message}"""
 Question: {user_message}"""
             })
         
-        response = client.messages.create(
+        response = create_message(
+            client, 'answer',
+            limiter=upstream,
             model="claude-3-haiku-20240307",
             max_tokens=1000,
             messages=messages
@@ -311,7 +471,9 @@ Format your response as:
 Label: [your label]
 Explanation: [your explanation]"""
                 
-                eval_response = client.messages.create(
+                eval_response = create_message(
+                    client, 'judge', criterion_type[:40],
+                    limiter=upstream,
                     model="claude-3-haiku-20240307",
                     max_tokens=500,
                     messages=[{
@@ -321,7 +483,7 @@ Explanation: [your explanation]"""
                 )
                 evaluations.append({
                     'type': criterion_type,
-                    'evaluation': eval_response.content[0].text
+                    'evaluation': display_evaluation(eval_response.content[0].text)
                 })
             
             # Combine evaluations into a single structured response
@@ -341,7 +503,9 @@ Explanation: [your explanation]"""
                     response=ai_response
                 )
             
-            eval_response = client.messages.create(
+            eval_response = create_message(
+                client, 'judge', 'custom' if custom_prompt else 'groundedness',
+                limiter=upstream,
                 model="claude-3-haiku-20240307",
                 max_tokens=500,
                 messages=[{
@@ -349,7 +513,17 @@ Explanation: [your explanation]"""
                     "content": eval_prompt
                 }]
             )
-            evaluation = eval_response.content[0].text
+            evaluation = display_evaluation(eval_response.content[0].text)
+        
+        # Persist the turn asynchronously
+        with span('persist'):
+            usage_keys = {'user_key': key_fingerprint(api_key), 'document': pdf_content}
+            if combined_evaluation:
+                record_turn(user_message, ai_response, combined_evaluation, **usage_keys)
+            else:
+                record_turn(user_message, ai_response,
+                            [{'type': 'groundedness', 'evaluation': evaluation}] if evaluation else [],
+                            **usage_keys)
         
         # Add to session history if there's an evaluation (with size limit)
         if evaluation and 'evaluation_history' in session:
@@ -376,9 +550,70 @@ Explanation: [your explanation]"""
     
     except anthropic.AuthenticationError:
         return jsonify({'error': 'Invalid API key. Please check your Anthropic API key.'}), 401
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+USAGE_GROUPS = {
+    'session': ChatSession.session_id,
+    'user': ModelCall.user_key,
+    'criterion': ModelCall.criterion,
+    'stage': ModelCall.stage,
+    'model': ModelCall.model,
+    'document': ModelCall.document_hash
+}
+
+@app.route('/usage')
+def usage_summary():
+    """Token usage, spend and latency of model calls, grouped by one dimension.
+
+    Covers the current session unless scope=all is requested with the
+    X-Admin-Token header matching USAGE_ADMIN_TOKEN.
+    """
+    group_by = request.args.get('group_by', 'criterion')
+    if group_by not in USAGE_GROUPS:
+        return jsonify({'error': f"group_by must be one of: {', '.join(USAGE_GROUPS)}"}), 400
+    days = min(max(request.args.get('days', 7, type=int), 1), 365)
+    scope = request.args.get('scope', 'session')
+    
+    admin_token = os.environ.get('USAGE_ADMIN_TOKEN')
+    if scope == 'all' and not (admin_token and request.headers.get('X-Admin-Token') == admin_token):
+        return jsonify({'error': 'scope=all requires a valid X-Admin-Token'}), 403
+    
+    key = USAGE_GROUPS[group_by]
+    token_sums = [db.func.coalesce(db.func.sum(getattr(ModelCall, f'{kind}_tokens')), 0) for kind in TOKEN_KINDS]
+    cost = db.func.coalesce(db.func.sum(ModelCall.cost_usd), 0)
+    query = db.session.query(
+        key,
+        db.func.count(ModelCall.id),
+        *token_sums,
+        cost,
+        db.func.avg(ModelCall.latency_ms),
+        db.func.max(ModelCall.latency_ms)
+    ).join(ChatSession, ChatSession.id == ModelCall.session_id)\
+     .filter(ModelCall.timestamp >= datetime.utcnow() - timedelta(days=days))
+    if scope != 'all':
+        query = query.filter(ChatSession.session_id == session.get('session_id'))
+    rows = query.group_by(key).order_by(cost.desc()).limit(100).all()
+    
+    groups = []
+    for row in rows:
+        group = {group_by: row[0], 'calls': row[1]}
+        group.update({f'{kind}_tokens': int(value) for kind, value in zip(TOKEN_KINDS, row[2:6])})
+        group['cost_usd'] = round(row[6], 6)
+        group['avg_latency_ms'] = round(row[7], 1) if row[7] is not None else None
+        group['max_latency_ms'] = row[8]
+        groups.append(group)
+    
+    return jsonify({
+        'group_by': group_by,
+        'scope': 'all' if scope == 'all' else 'session',
+        'days': days,
+        'groups': groups,
+        'total_cost_usd': round(sum(group['cost_usd'] for group in groups), 6)
+    })
+
 @app.route('/upload_pdf', methods=['POST'])
 def upload_pdf():
     try:
@@ -388,17 +623,19 @@ def upload_pdf():
         if pdf_data.startswith('data:application/pdf;base64,'):
             pdf_data = pdf_data.split(',')[1]
         
-        pdf_bytes = base64.b64decode(pdf_data)
-        pdf_file = io.BytesIO(pdf_bytes)
+        with span('pdf_decode'):
+            pdf_bytes = base64.b64decode(pdf_data)
+            pdf_file = io.BytesIO(pdf_bytes)
         
-        reader = PdfReader(pdf_file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
+        with span('pdf_extract'):
+            reader = PdfReader(pdf_file)
+            text = ""
+            for page in reader.pages:
+                text += page.extract_text() + "\n"
         
         # Store PDF content in session (now handled server-side by Flask-Session)
         session['pdf_content'] = text[:10000]
-        print(f"DEBUG UPLOAD: Stored PDF in session, length: {len(text[:10000])}")
+        logger.debug('PDF stored in session', extra={'pdf_chars': len(session['pdf_content'])})
         session.modified = True
         
         return jsonify({
@@ -435,12 +672,13 @@ def improve_response():
         
         # Create Anthropic client with user's API key
         try:
-            client = anthropic.Anthropic(api_key=api_key)
+            client = get_client(api_key)
         except Exception as e:
             return jsonify({'error': f'Invalid API key: {str(e)}'}), 401
         
         # Get PDF content from session (now handled server-side by Flask-Session)
-        pdf_content = session.get('pdf_content', '')
+        with span('pdf_lookup'):
+            pdf_content = session.get('pdf_content', '')
         
         # Build improvement prompt based on all evaluations
         if combined_evaluation and len(combined_evaluation) > 0:
@@ -485,7 +723,9 @@ Original question: {original_question}
 
 Please provide an improved, well-formatted response:"""
         
-        response = client.messages.create(
+        response = create_message(
+            client, 'improve',
+            limiter=upstream,
             model="claude-3-haiku-20240307",
             max_tokens=1000,
             messages=[{
@@ -516,7 +756,9 @@ Please provide an improved, well-formatted response:"""
                         response=improved_response
                     )
                 
-                eval_response = client.messages.create(
+                eval_response = create_message(
+                    client, 'judge', criterion_type[:40],
+                    limiter=upstream,
                     model="claude-3-haiku-20240307",
                     max_tokens=500,
                     messages=[{
@@ -526,7 +768,7 @@ Please provide an improved, well-formatted response:"""
                 )
                 evaluations.append({
                     'type': criterion_type,
-                    'evaluation': eval_response.content[0].text
+                    'evaluation': display_evaluation(eval_response.content[0].text)
                 })
             
             new_combined_evaluation = evaluations
@@ -543,7 +785,9 @@ Please provide an improved, well-formatted response:"""
                 response=improved_response
             )
         
-        eval_response = client.messages.create(
+        eval_response = create_message(
+            client, 'judge', 'custom' if custom_prompt else 'groundedness',
+            limiter=upstream,
             model="claude-3-haiku-20240307",
             max_tokens=500,
             messages=[{
@@ -551,7 +795,19 @@ Please provide an improved, well-formatted response:"""
                 "content": eval_prompt
             }]
         )
-        new_evaluation = eval_response.content[0].text
+        new_evaluation = display_evaluation(eval_response.content[0].text)
+        
+        # Persist the improved turn asynchronously
+        with span('persist'):
+            # The question was stored with the original answer; add only the improved answer
+            usage_keys = {'user_key': key_fingerprint(api_key), 'document': pdf_content}
+            if new_combined_evaluation:
+                record_turn(original_question, improved_response, new_combined_evaluation,
+                            include_question=False, **usage_keys)
+            else:
+                record_turn(original_question, improved_response,
+                            [{'type': 'groundedness', 'evaluation': new_evaluation}] if new_evaluation else [],
+                            include_question=False, **usage_keys)
         
         # Add improved evaluation to session history
         if new_evaluation and 'evaluation_history' in session:
@@ -578,6 +834,8 @@ Please provide an improved, well-formatted response:"""
     
     except anthropic.AuthenticationError:
         return jsonify({'error': 'Invalid API key. Please check your Anthropic API key.'}), 401
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -11,12 +11,19 @@ import base64
 from datetime import datetime
 import redis
 import json
+import logging
 import uuid
+from anthropic_clients import get_client
+from structured_logging import configure_logging, init_request_logging
+from health import DependencyProber, database_check, redis_ping_check, db_pool_stats, health_status, init_health
 
 load_dotenv()
+configure_logging()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
+init_request_logging(app)
 
 # Configuration
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
@@ -36,7 +43,14 @@ try:
     redis_client.ping()
 except:
     redis_client = None
-    print("Redis not available, using in-memory storage")
+    logger.warning('Redis not available, using in-memory storage', extra={'redis_url': redis_url.split('@')[-1]})
+
+# Dependency checks run on a background thread; /healthz, /readyz and /health read the cached results
+dependency_prober = DependencyProber.from_env({
+    'database': (database_check(app, db), True),
+    'redis': (redis_ping_check(redis_client), False)
+})
+init_health(app, dependency_prober, lambda: {'database': db_pool_stats(db.engine)})
 
 # Store PDF content in session
 pdf_content = ""
@@ -94,27 +108,13 @@ def index():
 
 @app.route('/health')
 def health_check():
-    """Health check endpoint for Render monitoring"""
-    try:
-        # Check database connection
-        db.session.execute('SELECT 1')
-        db_status = 'healthy'
-    except:
-        db_status = 'unhealthy'
-    
-    # Check Redis connection if available
-    redis_status = 'not configured'
-    if redis_client:
-        try:
-            redis_client.ping()
-            redis_status = 'healthy'
-        except:
-            redis_status = 'unhealthy'
-    
+    """Health check endpoint for Render monitoring; reports the background prober's cached results"""
+    _, checks = dependency_prober.snapshot()
     return jsonify({
         'status': 'healthy',
-        'database': db_status,
-        'redis': redis_status,
+        'database': health_status(checks, 'database'),
+        'redis': health_status(checks, 'redis'),
+        'db_pool': db_pool_stats(db.engine),
         'timestamp': datetime.utcnow().isoformat()
     })
 
@@ -129,7 +129,7 @@ def validate_api_key():
             return jsonify({'valid': False, 'error': 'No API key provided'}), 400
         
         # Test the API key with a minimal request
-        test_client = anthropic.Anthropic(api_key=api_key)
+        test_client = get_client(api_key)
         test_client.messages.create(
             model="claude-3-haiku-20240307",
             max_tokens=10,
@@ -158,7 +158,7 @@ def chat():
         
         # Create Anthropic client with user's API key
         try:
-            client = anthropic.Anthropic(api_key=api_key)
+            client = get_client(api_key)
         except Exception as e:
             return jsonify({'error': f'Invalid API key: {str(e)}'}), 401
         
@@ -302,7 +302,7 @@ def improve_response():
         
         # Create Anthropic client with user's API key
         try:
-            client = anthropic.Anthropic(api_key=api_key)
+            client = get_client(api_key)
         except Exception as e:
             return jsonify({'error': f'Invalid API key: {str(e)}'}), 401
         
@@ -5,18 +5,30 @@ from flask_migrate import Migrate
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from authlib.integrations.flask_client import OAuth
 from cryptography.fernet import Fernet
-import anthropic
 import os
 from dotenv import load_dotenv
 from pypdf import PdfReader
 import io
 import base64
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
+from sqlalchemy.dialects import postgresql, sqlite
 import redis
 import json
+import click
+import logging
 import uuid
+from pagination import encode_cursor, decode_cursor, keyset_before
+from model_usage import create_message, request_model_calls, total_tokens
+from anthropic_clients import get_client
+from evaluation_parser import display_evaluation
+from structured_logging import configure_logging, init_request_logging
+from metrics import init_metrics
+from query_metrics import init_query_metrics
+from health import DependencyProber, database_check, redis_ping_check, db_pool_stats, health_status, init_health
 
 load_dotenv()
+configure_logging()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
@@ -34,7 +46,10 @@ cipher_suite = Fernet(ENCRYPTION_KEY.encode() if isinstance(ENCRYPTION_KEY, str)
 
 # Initialize extensions
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, directory='migrations_auth')
+init_metrics(app)
+init_request_logging(app)
+init_query_metrics(app, db)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -58,7 +73,14 @@ try:
     redis_client.ping()
 except:
     redis_client = None
-    print("Redis not available, using in-memory storage")
+    logger.warning('Redis not available, using in-memory storage', extra={'redis_url': redis_url.split('@')[-1]})
+
+# Dependency checks run on a background thread; /healthz, /readyz and /health read the cached results
+dependency_prober = DependencyProber.from_env({
+    'database': (database_check(app, db), True),
+    'redis': (redis_ping_check(redis_client), False)
+})
+init_health(app, dependency_prober, lambda: {'database': db_pool_stats(db.engine)})
 
 # Database Models
 class User(UserMixin, db.Model):
@@ -89,21 +111,23 @@ class User(UserMixin, db.Model):
         """Get Anthropic client with user's API key"""
         api_key = self.get_api_key()
         if api_key:
-            return anthropic.Anthropic(api_key=api_key)
+            return get_client(api_key)
         return None
 
 class ChatSession(db.Model):
+    __table_args__ = (db.Index('ix_chat_session_user_created', 'user_id', 'created_at', 'id'),)
+    
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(100), unique=True, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    pdf_content = db.Column(db.Text)  # Store PDF content per session
+    pdf_content = db.deferred(db.Column(db.Text))  # Store PDF content per session; loaded only on access
     messages = db.relationship('Message', backref='session', lazy=True)
     evaluations = db.relationship('Evaluation', backref='session', lazy=True)
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False, index=True)
     role = db.Column(db.String(20), nullable=False)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -124,6 +148,94 @@ class UsageLog(db.Model):
     tokens_used = db.Column(db.Integer, default=0)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+class UsageRollup(db.Model):
+    """Per-user, per-day usage counters maintained incrementally on write"""
+    __table_args__ = (db.UniqueConstraint('user_id', 'day', 'action', name='uq_usage_rollup_user_day_action'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    action = db.Column(db.String(50), nullable=False)
+    messages = db.Column(db.Integer, nullable=False, default=0)
+    evaluations = db.Column(db.Integer, nullable=False, default=0)
+    tokens = db.Column(db.Integer, nullable=False, default=0)
+
+def bump_usage_rollup(user_id, action, messages=0, evaluations=0, tokens=0, day=None):
+    """Add to the user's rollup row for the day, creating it if needed (atomic upsert)"""
+    values = {
+        'user_id': user_id,
+        'day': day or datetime.utcnow().date(),
+        'action': action,
+        'messages': messages,
+        'evaluations': evaluations,
+        'tokens': tokens
+    }
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(UsageRollup).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'day', 'action'],
+            set_={
+                'messages': UsageRollup.messages + stmt.excluded.messages,
+                'evaluations': UsageRollup.evaluations + stmt.excluded.evaluations,
+                'tokens': UsageRollup.tokens + stmt.excluded.tokens
+            }
+        )
+        db.session.execute(stmt)
+        return
+    
+    # Other databases: update in place, insert if nothing matched
+    result = db.session.execute(
+        db.update(UsageRollup)
+        .where(UsageRollup.user_id == user_id, UsageRollup.day == values['day'], UsageRollup.action == action)
+        .values(messages=UsageRollup.messages + messages,
+                evaluations=UsageRollup.evaluations + evaluations,
+                tokens=UsageRollup.tokens + tokens)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        db.session.execute(db.insert(UsageRollup).values(**values))
+
+def record_chat_turn(chat_session_pk, user_id, user_message, ai_response, evaluation, tokens_used=0):
+    """Stage all rows for one chat turn on the current transaction.
+
+    Both messages go in as one multi-row insert, and the user's usage counter
+    is bumped with an atomic UPDATE so the User row is never read-modify-written.
+    The caller commits.
+    """
+    now = datetime.utcnow()
+    db.session.execute(db.insert(Message), [
+        {'session_id': chat_session_pk, 'role': 'user', 'content': user_message, 'timestamp': now},
+        {'session_id': chat_session_pk, 'role': 'assistant', 'content': ai_response, 'timestamp': now}
+    ])
+    
+    if evaluation:
+        db.session.execute(db.insert(Evaluation).values(
+            session_id=chat_session_pk,
+            question=user_message,
+            response=ai_response,
+            evaluation_result=evaluation,
+            timestamp=now
+        ))
+    
+    db.session.execute(db.insert(UsageLog).values(
+        user_id=user_id,
+        action='chat',
+        tokens_used=tokens_used,
+        timestamp=now
+    ))
+    
+    db.session.execute(
+        db.update(User)
+        .where(User.id == user_id)
+        .values(usage_count=db.func.coalesce(User.usage_count, 0) + 1)
+        .execution_options(synchronize_session=False)
+    )
+    
+    bump_usage_rollup(user_id, 'chat', messages=2, evaluations=1 if evaluation else 0,
+                      tokens=tokens_used, day=now.date())
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -140,13 +252,8 @@ User Question:
 AI Response:
 {response}
 
-Evaluate the response and provide:
-1. A label: "Grounded", "Partially Grounded", or "Not Grounded"
-2. A brief explanation (2-3 sentences) of your evaluation
-
-Format your response as:
-Label: [your label]
-Explanation: [your explanation]"""
+Evaluate the response and reply with only a JSON object, no other text:
+{"label": "Grounded" | "Partially Grounded" | "Not Grounded", "explanation": "<2-3 sentences>"}"""
 
 @app.route('/')
 def index():
@@ -223,7 +330,7 @@ def save_api_key():
     
     # Test the API key
     try:
-        test_client = anthropic.Anthropic(api_key=api_key)
+        test_client = get_client(api_key)
         # Make a minimal test request
         test_client.messages.create(
             model="claude-3-haiku-20240307",
@@ -253,25 +360,17 @@ def chat():
         session_id = data.get('session_id')
         custom_prompt = data.get('evaluation_prompt', None)
         
-        # Get or create session
+        # Look up the session; a new one is created with the turn's other rows below
         chat_session = None
         if session_id:
-            chat_session = ChatSession.query.filter_by(
+            chat_session = ChatSession.query.options(db.undefer(ChatSession.pdf_content)).filter_by(
                 session_id=session_id, 
                 user_id=current_user.id
             ).first()
         
-        if not chat_session:
-            chat_session = ChatSession(
-                session_id=str(uuid.uuid4()),
-                user_id=current_user.id
-            )
-            db.session.add(chat_session)
-            db.session.commit()
-        
         # Prepare messages
         messages = []
-        pdf_content = chat_session.pdf_content or ""
+        pdf_content = (chat_session.pdf_content if chat_session else None) or ""
         
         if pdf_content:
             messages.append({
@@ -303,7 +402,8 @@ Question: {user_message}"""
             })
         
         # Get AI response
-        response = client.messages.create(
+        response = create_message(
+            client, 'answer',
             model="claude-3-haiku-20240307",
             max_tokens=1000,
             messages=messages
@@ -311,21 +411,6 @@ Question: {user_message}"""
         
         ai_response = response.content[0].text
         
-        # Save message to database
-        msg = Message(
-            session_id=chat_session.id,
-            role='user',
-            content=user_message
-        )
-        db.session.add(msg)
-        
-        msg = Message(
-            session_id=chat_session.id,
-            role='assistant',
-            content=ai_response
-        )
-        db.session.add(msg)
-        
         # Evaluate if PDF content exists
         evaluation = None
         if pdf_content:
@@ -334,7 +419,8 @@ Question: {user_message}"""
             eval_prompt = eval_prompt.replace('{question}', user_message)
             eval_prompt = eval_prompt.replace('{response}', ai_response)
             
-            eval_response = client.messages.create(
+            eval_response = create_message(
+                client, 'judge', 'custom' if custom_prompt else 'groundedness',
                 model="claude-3-haiku-20240307",
                 max_tokens=500,
                 messages=[{
@@ -342,28 +428,19 @@ Question: {user_message}"""
                     "content": eval_prompt
                 }]
             )
-            evaluation = eval_response.content[0].text
-            
-            # Save evaluation
-            eval_obj = Evaluation(
-                session_id=chat_session.id,
-                question=user_message,
-                response=ai_response,
-                evaluation_result=evaluation
-            )
-            db.session.add(eval_obj)
+            evaluation = display_evaluation(eval_response.content[0].text)
         
-        # Update usage count
-        current_user.usage_count += 1
-        
-        # Log usage
-        usage = UsageLog(
-            user_id=current_user.id,
-            action='chat',
-            tokens_used=1000  # Approximate
-        )
-        db.session.add(usage)
+        # Persist the whole turn in a single transaction
+        if not chat_session:
+            chat_session = ChatSession(
+                session_id=str(uuid.uuid4()),
+                user_id=current_user.id
+            )
+            db.session.add(chat_session)
+            db.session.flush()
         
+        record_chat_turn(chat_session.id, current_user.id, user_message, ai_response, evaluation,
+                         tokens_used=total_tokens(request_model_calls()))
         db.session.commit()
         
         return jsonify({
@@ -423,32 +500,59 @@ def upload_pdf():
 @app.route('/user_sessions')
 @login_required
 def user_sessions():
-    """Get all sessions for the current user"""
-    sessions = ChatSession.query.filter_by(user_id=current_user.id)\
-        .order_by(ChatSession.created_at.desc())\
-        .limit(10)\
+    """Get the current user's sessions, newest first, with cursor pagination"""
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    cursor = request.args.get('cursor')
+    
+    # Counts and the document flag are computed in the database, one query per page
+    message_count = db.select(db.func.count(Message.id))\
+        .where(Message.session_id == ChatSession.id)\
+        .correlate(ChatSession)\
+        .scalar_subquery()
+    has_document = db.and_(ChatSession.pdf_content.isnot(None), ChatSession.pdf_content != '')
+    
+    query = db.session.query(
+        ChatSession.id,
+        ChatSession.session_id,
+        ChatSession.created_at,
+        message_count.label('message_count'),
+        has_document.label('has_pdf')
+    ).filter(ChatSession.user_id == current_user.id)
+    
+    if cursor:
+        try:
+            created_at, row_id = decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        query = query.filter(keyset_before(ChatSession.created_at, ChatSession.id, created_at, row_id))
+    
+    rows = query.order_by(ChatSession.created_at.desc(), ChatSession.id.desc())\
+        .limit(limit + 1)\
         .all()
     
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    
     return jsonify({
         'sessions': [{
             'id': s.session_id,
             'created_at': s.created_at.isoformat(),
-            'message_count': len(s.messages),
-            'has_pdf': bool(s.pdf_content)
-        } for s in sessions]
+            'message_count': s.message_count,
+            'has_pdf': bool(s.has_pdf)
+        } for s in rows],
+        'next_cursor': next_cursor
     })
 
 @app.route('/usage_stats')
 @login_required
 def usage_stats():
     """Get usage statistics for the current user"""
-    total_messages = Message.query.join(ChatSession)\
-        .filter(ChatSession.user_id == current_user.id)\
-        .count()
-    
-    total_evaluations = Evaluation.query.join(ChatSession)\
-        .filter(ChatSession.user_id == current_user.id)\
-        .count()
+    total_messages, total_evaluations = db.session.query(
+        db.func.coalesce(db.func.sum(UsageRollup.messages), 0),
+        db.func.coalesce(db.func.sum(UsageRollup.evaluations), 0)
+    ).filter(UsageRollup.user_id == current_user.id).one()
     
     return jsonify({
         'total_messages': total_messages,
@@ -457,31 +561,94 @@ def usage_stats():
         'member_since': current_user.created_at.isoformat()
     })
 
-@app.route('/health')
-def health_check():
-    """Health check endpoint for Render monitoring"""
-    try:
-        db.session.execute('SELECT 1')
-        db_status = 'healthy'
-    except:
-        db_status = 'unhealthy'
+@app.route('/usage_rollups')
+@login_required
+def usage_rollups():
+    """Get per-day usage for the current user, read straight from the rollup table"""
+    days = request.args.get('days', 30, type=int)
+    since = datetime.utcnow().date() - timedelta(days=max(days, 1) - 1)
     
-    redis_status = 'not configured'
-    if redis_client:
-        try:
-            redis_client.ping()
-            redis_status = 'healthy'
-        except:
-            redis_status = 'unhealthy'
+    rows = UsageRollup.query.filter(
+        UsageRollup.user_id == current_user.id,
+        UsageRollup.day >= since
+    ).order_by(UsageRollup.day.desc(), UsageRollup.action).all()
+    
+    by_day = {}
+    totals = {'messages': 0, 'evaluations': 0, 'tokens': 0}
+    for row in rows:
+        day = by_day.setdefault(row.day, {
+            'day': row.day.isoformat(),
+            'messages': 0,
+            'evaluations': 0,
+            'tokens': 0,
+            'by_action': {}
+        })
+        counts = {'messages': row.messages, 'evaluations': row.evaluations, 'tokens': row.tokens}
+        day['by_action'][row.action] = counts
+        for key, value in counts.items():
+            day[key] += value
+            totals[key] += value
     
+    return jsonify({
+        'days': list(by_day.values()),
+        'totals': totals,
+        'since': since.isoformat()
+    })
+
+@app.route('/health')
+def health_check():
+    """Health check endpoint for Render monitoring; reports the background prober's cached results"""
+    _, checks = dependency_prober.snapshot()
     return jsonify({
         'status': 'healthy',
-        'database': db_status,
-        'redis': redis_status,
+        'database': health_status(checks, 'database'),
+        'redis': health_status(checks, 'redis'),
         'auth': 'google_oauth',
+        'db_pool': db_pool_stats(db.engine),
         'timestamp': datetime.utcnow().isoformat()
     })
 
+@app.cli.command('backfill-usage-rollups')
+def backfill_usage_rollups():
+    """Rebuild the usage rollup table from Message, Evaluation and UsageLog rows"""
+    def as_date(value):
+        return date.fromisoformat(value) if isinstance(value, str) else value
+    
+    rollups = {}
+    def bucket(user_id, day, action):
+        return rollups.setdefault((user_id, as_date(day), action),
+                                  {'messages': 0, 'evaluations': 0, 'tokens': 0})
+    
+    message_counts = db.session.query(
+        ChatSession.user_id, db.func.date(Message.timestamp), db.func.count(Message.id)
+    ).join(ChatSession, Message.session_id == ChatSession.id)\
+     .group_by(ChatSession.user_id, db.func.date(Message.timestamp))
+    for user_id, day, count in message_counts:
+        bucket(user_id, day, 'chat')['messages'] += count
+    
+    evaluation_counts = db.session.query(
+        ChatSession.user_id, db.func.date(Evaluation.timestamp), db.func.count(Evaluation.id)
+    ).join(ChatSession, Evaluation.session_id == ChatSession.id)\
+     .group_by(ChatSession.user_id, db.func.date(Evaluation.timestamp))
+    for user_id, day, count in evaluation_counts:
+        bucket(user_id, day, 'chat')['evaluations'] += count
+    
+    token_counts = db.session.query(
+        UsageLog.user_id, db.func.date(UsageLog.timestamp), UsageLog.action,
+        db.func.coalesce(db.func.sum(UsageLog.tokens_used), 0)
+    ).group_by(UsageLog.user_id, db.func.date(UsageLog.timestamp), UsageLog.action)
+    for user_id, day, action, tokens in token_counts:
+        bucket(user_id, day, action or 'chat')['tokens'] += tokens
+    
+    db.session.execute(db.delete(UsageRollup))
+    if rollups:
+        db.session.execute(db.insert(UsageRollup), [
+            dict(counts, user_id=user_id, day=day, action=action)
+            for (user_id, day, action), counts in rollups.items()
+        ])
+    db.session.commit()
+    click.echo(f"Rebuilt {len(rollups)} usage rollup rows")
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
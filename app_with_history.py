@@ -1,6 +1,7 @@
-from flask import Flask, render_template, request, jsonify, session, send_file
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
 from flask_cors import CORS
-import anthropic
+import click
+import json
 import os
 from dotenv import load_dotenv
 from pypdf import PdfReader
@@ -8,11 +9,27 @@ import io
 import base64
 import uuid
 from datetime import datetime, timedelta
-import json
-import csv
-from models import db, EvaluationHistory
+from flask_migrate import Migrate
+from models import db, Document, EvaluationHistory
+from history_search import apply_search, search_snippets, install_search_index
+from pagination import encode_cursor, decode_cursor, keyset_before, encode_offset_cursor, decode_offset_cursor
+from ttl_cache import TTLCache
+from history_stats import HistoryStatsCache, stats_response, history_stats_query
+from evaluation_parser import format_evaluation
+from metrics import init_metrics, span
+from profiling import init_profiling
+from query_metrics import init_query_metrics
+from health import DependencyProber, database_check, db_pool_stats, init_health
+from structured_logging import configure_logging, init_request_logging
+from model_usage import create_message
+from anthropic_clients import clients as anthropic_clients, get_client
+from memory_budget import monitor as memory
+from history_retention import RetentionPolicy, RetentionJob, purge_history
+from history_export import (EXPORT_FORMATS, COLUMNAR_FORMATS, iter_records, export_chunks, gzip_chunks,
+                            columnar_available, columnar_chunks)
 
 load_dotenv()
+configure_logging()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
@@ -21,12 +38,52 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 CORS(app)
 db.init_app(app)
+migrate = Migrate(app, db, directory='migrations_history')
+init_metrics(app)
+init_request_logging(app)
+init_profiling(app)
+init_query_metrics(app, db)
+init_health(app, DependencyProber.from_env({'database': (database_check(app, db), True)}),
+            lambda: {'database': db_pool_stats(db.engine)})
 
-client = anthropic.Anthropic()
+client = get_client()
 
 pdf_content = ""
 pdf_filename = ""
 
+# /history totals per filter set, keyed (session_id, groundedness, search, date_from, date_to).
+# A write here drops only its session's entries (and the all-sessions ones); writes in other
+# workers are not seen until an entry expires, so totals there can be HISTORY_TOTALS_TTL
+# seconds stale. Keep it short.
+history_totals = TTLCache(ttl=float(os.getenv('HISTORY_TOTALS_TTL', '5')))
+
+# /history/stats counts per session, updated in place as evaluations are written. Other
+# workers' writes only show up when an entry expires, so keep HISTORY_STATS_TTL short.
+history_stats = HistoryStatsCache(ttl=float(os.getenv('HISTORY_STATS_TTL', '5')))
+
+memory.track('history_totals', lambda: {'items': len(history_totals)})
+memory.track('history_stats', lambda: {'items': len(history_stats)})
+memory.track('anthropic_clients', lambda: {'items': anthropic_clients.stats()['clients']})
+
+def invalidate_history_totals(session_id):
+    history_totals.discard_where(lambda key: not key[0] or key[0] == session_id)
+
+def clear_history_caches(report=None):
+    history_totals.clear()
+    history_stats.clear()
+
+# Periodic retention; off unless HISTORY_RETENTION_INTERVAL and a policy are set.
+# Every worker starts the job, but only the one holding HISTORY_RETENTION_LOCK purges.
+retention = RetentionJob(
+    app,
+    RetentionPolicy.from_env(),
+    interval=int(os.getenv('HISTORY_RETENTION_INTERVAL', '0')),
+    on_purged=clear_history_caches,
+    lock_path=os.getenv('HISTORY_RETENTION_LOCK'),
+    batch_size=int(os.getenv('HISTORY_RETENTION_BATCH_SIZE', '500')),
+    pause=float(os.getenv('HISTORY_RETENTION_PAUSE', '0.1'))
+)
+
 GROUNDEDNESS_PROMPT = """You are evaluating whether an AI response is grounded in the provided document context.
 
 Document Context:
@@ -38,13 +95,8 @@ User Question:
 AI Response:
 {response}
 
-Evaluate the response and provide:
-1. A label: "Grounded", "Partially Grounded", or "Not Grounded"
-2. A brief explanation (2-3 sentences) of your evaluation
-
-Format your response as:
-Label: [your label]
-Explanation: [your explanation]"""
+Evaluate the response and reply with only a JSON object, no other text:
+{{"label": "Grounded" | "Partially Grounded" | "Not Grounded", "explanation": "<2-3 sentences>"}}"""
 
 @app.before_request
 def before_request():
@@ -52,6 +104,7 @@ def before_request():
         session['session_id'] = str(uuid.uuid4())
     session.permanent = True
     app.permanent_session_lifetime = timedelta(days=7)
+    retention.ensure_started()
 
 @app.route('/')
 def index():
@@ -77,7 +130,8 @@ def chat():
                 "content": user_message
             })
         
-        response = client.messages.create(
+        response = create_message(
+            client, 'answer',
             model="claude-3-haiku-20240307",
             max_tokens=1000,
             messages=messages
@@ -90,7 +144,8 @@ def chat():
         evaluation_explanation = None
         
         if pdf_content:
-            eval_response = client.messages.create(
+            eval_response = create_message(
+                client, 'judge', 'groundedness',
                 model="claude-3-haiku-20240307",
                 max_tokens=500,
                 messages=[{
@@ -104,20 +159,26 @@ def chat():
             )
             evaluation = eval_response.content[0].text
             groundedness_level, evaluation_explanation = EvaluationHistory.parse_evaluation(evaluation)
+            if groundedness_level:
+                # Store and return the "Label:/Explanation:" text the UI parses
+                evaluation = format_evaluation(groundedness_level, evaluation_explanation)
         
         # Store in database
-        eval_history = EvaluationHistory(
-            session_id=session['session_id'],
-            question=user_message,
-            response=ai_response,
-            evaluation=evaluation or '',
-            groundedness_level=groundedness_level,
-            evaluation_explanation=evaluation_explanation,
-            pdf_content=pdf_content[:1000] if pdf_content else None,
-            pdf_filename=pdf_filename
-        )
-        db.session.add(eval_history)
-        db.session.commit()
+        with span('db_commit'):
+            eval_history = EvaluationHistory(
+                session_id=session['session_id'],
+                question=user_message,
+                response=ai_response,
+                evaluation=evaluation or '',
+                groundedness_level=groundedness_level,
+                evaluation_explanation=evaluation_explanation,
+                document_id=Document.get_or_create(pdf_content[:1000]) if pdf_content else None,
+                pdf_filename=pdf_filename
+            )
+            db.session.add(eval_history)
+            db.session.commit()
+        invalidate_history_totals(eval_history.session_id)
+        history_stats.record(eval_history.session_id, groundedness_level, total=1)
         
         return jsonify({
             'response': ai_response,
@@ -140,13 +201,15 @@ def upload_pdf():
         if pdf_data.startswith('data:application/pdf;base64,'):
             pdf_data = pdf_data.split(',')[1]
         
-        pdf_bytes = base64.b64decode(pdf_data)
-        pdf_file = io.BytesIO(pdf_bytes)
+        with span('pdf_decode'):
+            pdf_bytes = base64.b64decode(pdf_data)
+            pdf_file = io.BytesIO(pdf_bytes)
         
-        reader = PdfReader(pdf_file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
+        with span('pdf_extract'):
+            reader = PdfReader(pdf_file)
+            text = ""
+            for page in reader.pages:
+                text += page.extract_text() + "\n"
         
         pdf_content = text[:10000]
         pdf_filename = filename
@@ -183,7 +246,8 @@ Original question: {original_question}
 
 Please provide an improved response:"""
         
-        response = client.messages.create(
+        response = create_message(
+            client, 'improve',
             model="claude-3-haiku-20240307",
             max_tokens=1000,
             messages=[{
@@ -194,7 +258,8 @@ Please provide an improved response:"""
         
         improved_response = response.content[0].text
         
-        eval_response = client.messages.create(
+        eval_response = create_message(
+            client, 'judge', 'groundedness',
             model="claude-3-haiku-20240307",
             max_tokens=500,
             messages=[{
@@ -207,14 +272,21 @@ Please provide an improved response:"""
             }]
         )
         new_evaluation = eval_response.content[0].text
+        new_label, new_explanation = EvaluationHistory.parse_evaluation(new_evaluation)
+        if new_label:
+            new_evaluation = format_evaluation(new_label, new_explanation)
         
         # Update history if ID provided
         if history_id:
             eval_history = EvaluationHistory.query.get(history_id)
             if eval_history:
+                newly_improved = eval_history.improved_response is None
                 eval_history.improved_response = improved_response
                 eval_history.improved_evaluation = new_evaluation
-                db.session.commit()
+                with span('db_commit'):
+                    db.session.commit()
+                if newly_improved:
+                    history_stats.record(eval_history.session_id, improved=1)
         
         return jsonify({
             'response': improved_response,
@@ -224,6 +296,54 @@ Please provide an improved response:"""
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Newest first; matches ix_evaluation_history_session_timestamp
+HISTORY_ORDER = (EvaluationHistory.timestamp.desc(), EvaluationHistory.id.desc())
+
+def filter_history(query, session_id=None, groundedness=None, date_from=None, date_to=None):
+    """Apply the /history filters to an EvaluationHistory query"""
+    if session_id:
+        query = query.filter_by(session_id=session_id)
+    
+    if groundedness:
+        query = query.filter_by(groundedness_level=groundedness)
+    
+    if date_from:
+        query = query.filter(EvaluationHistory.timestamp >= datetime.fromisoformat(date_from))
+    
+    if date_to:
+        query = query.filter(EvaluationHistory.timestamp <= datetime.fromisoformat(date_to))
+    
+    return query
+
+# Characters of each large text field returned by list views unless preview=false
+DEFAULT_PREVIEW_CHARS = 200
+
+def project_history(query, fields, preview_chars):
+    """Load only the columns behind `fields`.
+
+    Large text fields are truncated in SQL when preview_chars is set, so list
+    pages never transfer full documents. Returns (query, fields loaded in full).
+    """
+    preview_fields = [f for f in fields if preview_chars and f in EvaluationHistory.LARGE_FIELDS]
+    full_fields = [f for f in fields if f not in preview_fields]
+    columns = {'id', 'timestamp', *full_fields}  # id and timestamp are needed for cursors
+    query = query.options(db.load_only(*(getattr(EvaluationHistory, f) for f in columns)))
+    for field in preview_fields:
+        query = query.add_columns(db.func.substr(getattr(EvaluationHistory, field), 1, preview_chars).label(field))
+    return query, full_fields
+
+def history_record(row):
+    """The EvaluationHistory object in a result row that may carry extra columns"""
+    return row if isinstance(row, EvaluationHistory) else row[0]
+
+def serialize_history(row, full_fields):
+    """Row -> dict: projected model fields plus any extra labeled columns (previews, rank)"""
+    if isinstance(row, EvaluationHistory):
+        return row.to_dict(full_fields)
+    extras = dict(row._mapping)
+    record = extras.pop('EvaluationHistory')
+    return dict(record.to_dict(full_fields), **extras)
+
 @app.route('/history', methods=['GET'])
 def get_history():
     try:
@@ -233,46 +353,87 @@ def get_history():
         search = request.args.get('search')
         date_from = request.args.get('date_from')
         date_to = request.args.get('date_to')
-        limit = request.args.get('limit', 50, type=int)
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
         offset = request.args.get('offset', 0, type=int)
+        cursor = request.args.get('cursor')
+        include_total = request.args.get('include_total', 'true').lower() != 'false'
+        
+        # Projection: which fields to return, and whether large text is truncated
+        fields = tuple(f.strip() for f in request.args.get('fields', '').split(',') if f.strip()) \
+            or EvaluationHistory.FIELDS
+        unknown = set(fields) - set(EvaluationHistory.FIELDS)
+        if unknown:
+            return jsonify({'error': f"Unknown fields: {', '.join(sorted(unknown))}"}), 400
+        preview = request.args.get('preview', 'true').lower()
+        if preview in ('false', '0', 'no'):
+            preview_chars = 0
+        elif preview in ('true', 'yes'):
+            preview_chars = DEFAULT_PREVIEW_CHARS
+        elif preview.isdigit():
+            preview_chars = int(preview)
+        else:
+            return jsonify({'error': 'preview must be true, false or a number of characters'}), 400
         
         # Build query
-        query = EvaluationHistory.query
-        
-        if session_id:
-            query = query.filter_by(session_id=session_id)
-        
-        if groundedness:
-            query = query.filter_by(groundedness_level=groundedness)
+        query = filter_history(EvaluationHistory.query, session_id, groundedness, date_from, date_to)
         
+        ranked = False
         if search:
-            query = query.filter(
-                db.or_(
-                    EvaluationHistory.question.contains(search),
-                    EvaluationHistory.response.contains(search)
+            # Full-text index search; ranked backends order best matches first
+            ranked_query, ranked = apply_search(query, search)
+            query = apply_search(query, search, ranked=False)[0]
+        
+        # Totals are cached briefly per filter set instead of recounted for every page
+        total = None
+        if include_total:
+            with span('count'):
+                total = history_totals.get_or_set(
+                    (session_id, groundedness, search, date_from, date_to), query.count
                 )
-            )
         
-        if date_from:
-            query = query.filter(EvaluationHistory.timestamp >= datetime.fromisoformat(date_from))
-        
-        if date_to:
-            query = query.filter(EvaluationHistory.timestamp <= datetime.fromisoformat(date_to))
-        
-        # Get total count
-        total = query.count()
-        
-        # Apply pagination and get results
-        evaluations = query.order_by(EvaluationHistory.timestamp.desc())\
-                          .limit(limit)\
-                          .offset(offset)\
-                          .all()
+        if ranked:
+            # Relevance order has no stable keyset, so search pages by position
+            if cursor:
+                try:
+                    offset = decode_offset_cursor(cursor)
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+            page_query, full_fields = project_history(ranked_query, fields, preview_chars)
+            with span('query'):
+                rows = page_query.limit(limit + 1).offset(offset).all()
+            next_cursor = encode_offset_cursor(offset + limit) if len(rows) > limit else None
+            rows = rows[:limit]
+            with span('snippets'):
+                snippets = search_snippets([history_record(row).id for row in rows], search)
+            results = [dict(serialize_history(row, full_fields), snippet=snippets.get(history_record(row).id))
+                       for row in rows]
+        else:
+            # Keyset pagination on (timestamp, id); deep pages cost the same as the first
+            if cursor:
+                try:
+                    timestamp, row_id = decode_cursor(cursor)
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+                query = query.filter(keyset_before(EvaluationHistory.timestamp, EvaluationHistory.id,
+                                                   timestamp, row_id))
+            page_query, full_fields = project_history(query.order_by(*HISTORY_ORDER), fields, preview_chars)
+            if offset and not cursor:
+                page_query = page_query.offset(offset)  # Legacy offset paging
+            with span('query'):
+                rows = page_query.limit(limit + 1).all()
+            next_cursor = None
+            if len(rows) > limit:
+                last = history_record(rows[limit - 1])
+                next_cursor = encode_cursor(last.timestamp, last.id)
+            rows = rows[:limit]
+            results = [serialize_history(row, full_fields) for row in rows]
         
         return jsonify({
-            'evaluations': [eval.to_dict() for eval in evaluations],
+            'evaluations': results,
             'total': total,
             'limit': limit,
-            'offset': offset
+            'offset': offset,
+            'next_cursor': next_cursor
         })
     
     except Exception as e:
@@ -282,27 +443,9 @@ def get_history():
 def get_history_stats():
     try:
         session_id = request.args.get('session_id', session.get('session_id'))
-        
-        query = EvaluationHistory.query
-        if session_id:
-            query = query.filter_by(session_id=session_id)
-        
-        total = query.count()
-        grounded = query.filter_by(groundedness_level='Grounded').count()
-        partially = query.filter_by(groundedness_level='Partially Grounded').count()
-        not_grounded = query.filter_by(groundedness_level='Not Grounded').count()
-        
-        # Calculate improvement rate
-        with_improvement = query.filter(EvaluationHistory.improved_response.isnot(None)).count()
-        improvement_rate = (with_improvement / total * 100) if total > 0 else 0
-        
-        return jsonify({
-            'total_evaluations': total,
-            'grounded': grounded,
-            'partially_grounded': partially,
-            'not_grounded': not_grounded,
-            'improvement_rate': round(improvement_rate, 2)
-        })
+        with span('stats'):
+            counts = history_stats.get(session_id or None)
+        return jsonify(stats_response(counts))
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -312,64 +455,190 @@ def export_history():
     try:
         format = request.args.get('format', 'json')
         session_id = request.args.get('session_id', session.get('session_id'))
+        compress = request.args.get('gzip', 'false').lower() in ('1', 'true', 'yes')
+        
+        if format not in EXPORT_FORMATS and format not in COLUMNAR_FORMATS:
+            return jsonify({'error': f'Unsupported format: {format}'}), 400
+        if format in COLUMNAR_FORMATS and not columnar_available():
+            return jsonify({'error': f'{format} export requires pyarrow'}), 501
         
         query = EvaluationHistory.query
         if session_id:
             query = query.filter_by(session_id=session_id)
         
-        evaluations = query.order_by(EvaluationHistory.timestamp.desc()).all()
-        
-        if format == 'csv':
-            output = io.StringIO()
-            writer = csv.DictWriter(output, fieldnames=[
-                'id', 'timestamp', 'question', 'response', 'groundedness_level',
-                'evaluation_explanation', 'pdf_filename', 'improved_response'
-            ])
-            writer.writeheader()
-            
-            for eval in evaluations:
-                writer.writerow({
-                    'id': eval.id,
-                    'timestamp': eval.timestamp.isoformat(),
-                    'question': eval.question,
-                    'response': eval.response,
-                    'groundedness_level': eval.groundedness_level,
-                    'evaluation_explanation': eval.evaluation_explanation,
-                    'pdf_filename': eval.pdf_filename,
-                    'improved_response': eval.improved_response
-                })
-            
-            output.seek(0)
-            return send_file(
-                io.BytesIO(output.getvalue().encode()),
-                mimetype='text/csv',
-                as_attachment=True,
-                download_name=f'evaluation_history_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-            )
+        query = query.order_by(*HISTORY_ORDER)
         
-        else:  # JSON format
-            data = [eval.to_dict() for eval in evaluations]
-            return send_file(
-                io.BytesIO(json.dumps(data, indent=2).encode()),
-                mimetype='application/json',
-                as_attachment=True,
-                download_name=f'evaluation_history_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-            )
+        # Rows are fetched in batches and encoded as they stream out
+        if format in COLUMNAR_FORMATS:
+            # Parquet/Arrow compress internally; gzip would only add overhead
+            chunks = columnar_chunks(iter_records(query, batch_size=2000), format)
+            mimetype, extension = COLUMNAR_FORMATS[format]
+            compress = False
+        else:
+            chunks = export_chunks(iter_records(query), format)
+            mimetype, extension = EXPORT_FORMATS[format]
+        download_name = f'evaluation_history_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{extension}'
+        if compress:
+            chunks = gzip_chunks(chunks)
+            mimetype = 'application/gzip'
+            download_name += '.gz'
+        
+        return Response(
+            stream_with_context(chunks),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename={download_name}'}
+        )
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/history/<int:id>', methods=['GET'])
+def get_history_item(id):
+    """Full record, including the large text fields list views truncate"""
+    eval_history = db.session.get(EvaluationHistory, id)
+    if eval_history is None:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(eval_history.to_dict())
+
 @app.route('/history/<int:id>', methods=['DELETE'])
 def delete_history_item(id):
     try:
         eval_history = EvaluationHistory.query.get_or_404(id)
+        stats_delta = (eval_history.session_id, eval_history.groundedness_level,
+                       -1 if eval_history.improved_response is not None else 0)
         db.session.delete(eval_history)
         db.session.commit()
+        invalidate_history_totals(stats_delta[0])
+        history_stats.record(stats_delta[0], stats_delta[1], total=-1, improved=stats_delta[2])
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/history/retention', methods=['GET'])
+def get_history_retention():
+    return jsonify({
+        'enabled': retention.enabled,
+        'interval_seconds': retention.interval,
+        'policy': retention.policy.to_dict(),
+        # Runs and reports belong to the worker holding the retention lock
+        'leader': retention.leader,
+        'pid': os.getpid(),
+        'runs': retention.runs,
+        'failures': retention.failures,
+        'last_report': retention.last_report
+    })
+
+@app.cli.command('purge-history')
+@click.option('--days', type=int, help='Delete evaluations older than this many days')
+@click.option('--per-session', type=int, help='Keep only the newest N evaluations of each session')
+@click.option('--batch-size', default=500, show_default=True, help='Rows deleted per transaction')
+@click.option('--pause', default=0.1, show_default=True, help='Seconds to sleep between batches')
+@click.option('--vacuum', is_flag=True, help='VACUUM afterwards to return freed space')
+@click.option('--analyze', is_flag=True, help='ANALYZE afterwards to refresh planner statistics')
+@click.option('--dry-run', is_flag=True, help='Only count what would be deleted')
+def purge_history_command(days, per_session, batch_size, pause, vacuum, analyze, dry_run):
+    """Apply the retention policy (options override HISTORY_RETENTION_* settings)"""
+    policy = RetentionPolicy.from_env()
+    if days is not None:
+        policy.max_age_days = days
+    if per_session is not None:
+        policy.max_rows_per_session = per_session
+    if not policy.enabled:
+        raise click.UsageError('No retention policy: pass --days/--per-session or set HISTORY_RETENTION_*')
+    report = purge_history(policy, batch_size=batch_size, pause=pause,
+                           vacuum=vacuum, analyze=analyze, dry_run=dry_run)
+    click.echo(json.dumps(report, indent=2))
+
+@app.cli.command('backfill-labels')
+@click.option('--batch-size', default=500, show_default=True, help='Rows re-parsed per transaction')
+@click.option('--all', 'reparse_all', is_flag=True, help='Re-parse every row, not only rows without a label')
+@click.option('--dry-run', is_flag=True, help='Only count rows that would get a label')
+def backfill_labels(batch_size, reparse_all, dry_run):
+    """Fill groundedness_level/evaluation_explanation by re-parsing stored judge output (no model calls)"""
+    query = db.session.query(EvaluationHistory.id, EvaluationHistory.evaluation,
+                             EvaluationHistory.groundedness_level, EvaluationHistory.evaluation_explanation)\
+                      .filter(EvaluationHistory.evaluation.isnot(None), EvaluationHistory.evaluation != '')
+    if not reparse_all:
+        query = query.filter(db.or_(EvaluationHistory.groundedness_level.is_(None),
+                                    EvaluationHistory.groundedness_level == ''))
+    
+    scanned = updated = skipped = 0
+    last_id = 0
+    while True:
+        rows = query.filter(EvaluationHistory.id > last_id).order_by(EvaluationHistory.id).limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        scanned += len(rows)
+        changes = []
+        for row in rows:
+            label, explanation = EvaluationHistory.parse_evaluation(row.evaluation)
+            if not label:
+                # No confident groundedness label; leave the row for a human rather than guess
+                skipped += 1
+                continue
+            if (label, explanation) != (row.groundedness_level, row.evaluation_explanation):
+                changes.append({'id': row.id, 'groundedness_level': label, 'evaluation_explanation': explanation})
+        if changes and not dry_run:
+            # Bulk UPDATE by primary key, one executemany per batch
+            db.session.execute(db.update(EvaluationHistory), changes)
+            db.session.commit()
+        updated += len(changes)
+    
+    if updated and not dry_run:
+        clear_history_caches()
+    click.echo(f"Scanned {scanned} rows, {'would label' if dry_run else 'labelled'} {updated}, "
+          f"skipped {skipped} without a confident label")
+
+@app.cli.command('explain-history')
+@click.option('--session-id', default='example-session', help='Session id to plug into the queries')
+@click.option('--strict', is_flag=True, help='Exit non-zero if any plan scans the table or sorts in memory')
+def explain_history(session_id, strict):
+    """Print EXPLAIN plans for the main /history queries"""
+    dialect = db.engine.dialect
+    last_week = (datetime.utcnow() - timedelta(days=7)).isoformat()
+    last_seen = datetime.utcnow()
+    
+    queries = {
+        'history page': filter_history(EvaluationHistory.query, session_id).order_by(*HISTORY_ORDER).limit(50),
+        'history next page (cursor)': filter_history(EvaluationHistory.query, session_id)
+            .filter(keyset_before(EvaluationHistory.timestamp, EvaluationHistory.id, last_seen, 1000))
+            .order_by(*HISTORY_ORDER).limit(50),
+        'history by groundedness': filter_history(EvaluationHistory.query, session_id, groundedness='Grounded')
+            .order_by(*HISTORY_ORDER).limit(50),
+        'history by date range': filter_history(EvaluationHistory.query, session_id, date_from=last_week)
+            .order_by(*HISTORY_ORDER).limit(50),
+        'history count': filter_history(EvaluationHistory.query, session_id)
+            .with_entities(db.func.count(EvaluationHistory.id)),
+        'history stats': history_stats_query(session_id)
+    }
+    
+    if dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+        bad_patterns = ('SCAN evaluation_history', 'USE TEMP B-TREE')
+    else:
+        prefix = 'EXPLAIN '
+        bad_patterns = ('Seq Scan on evaluation_history', 'Sort  (')
+    
+    problems = []
+    with db.engine.connect() as conn:
+        for name, query in queries.items():
+            sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+            plan = [' | '.join(str(col) for col in row) if dialect.name == 'sqlite' else row[0]
+                    for row in conn.exec_driver_sql(prefix + sql)]
+            flagged = [line for line in plan
+                       if any(pattern in line for pattern in bad_patterns) and 'INDEX' not in line]
+            click.echo(f"== {name}{'  [WARNING: full scan or sort]' if flagged else ''}")
+            for line in plan:
+                click.echo(f"   {line}")
+            if flagged:
+                problems.append(name)
+    
+    if problems and strict:
+        raise SystemExit(f"Plans without index support: {', '.join(problems)}")
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        install_search_index(db.engine)
     app.run(debug=True, port=5002)
\ No newline at end of file
@@ -0,0 +1,260 @@
+"""Load-test app.py end to end against a local fake Anthropic API.
+
+Starts benchmarks/fake_anthropic.py in-process and app.py under gunicorn
+(using gunicorn.conf.py, with ANTHROPIC_BASE_URL pointed at the fake),
+then runs virtual users that upload a PDF once and call /chat with N
+evaluation criteria in a loop. Each (criteria, concurrency) step reports
+requests/s, p50/p95/p99 latency, errors and worker saturation:
+
+    busy   average number of requests in flight (sum of latencies / wall time)
+    util   busy / workers; near 1.0 the sync workers are saturated and extra
+           concurrency only queues
+
+No network access or API key is needed. Every virtual user sends the same
+API key, so the run also exercises the upstream limiter (upstream_limiter.py)
+with the deployment's UPSTREAM_* settings, as users sharing a server key would.
+
+Usage:
+    python benchmarks/bench_chat_load.py [--workers 4] [--criteria 1,3,10]
+        [--concurrency 1,2,4,8,16] [--duration 10] [--latency-ms 400]
+        [--jitter-ms 150] [--output-tokens 300] [--error-rate 0]
+"""
+import argparse
+import base64
+import http.cookiejar
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_anthropic import FakeAnthropicConfig, start_fake_anthropic  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DOCUMENT_LINES = [
+    'Evaluation data retention policy.',
+    'Records are kept for 90 days and reviewed quarterly.',
+    'Groundedness evaluations are stored with the question and response.',
+    'Deleted sessions are purged from backups within 30 days.'
+] * 10
+
+
+def make_pdf(lines):
+    """A minimal one-page PDF with the given text lines"""
+    text = ' '.join(f'({line}) Tj T*' for line in lines)
+    stream = f'BT /F1 10 Tf 12 TL 72 760 Td {text} ET'.encode()
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R '
+        b'/Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'
+    ]
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % number + obj + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return out
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(base_url, workers, log_path):
+    port = free_port()
+    tmpdir = tempfile.mkdtemp(prefix='chateval_load_')
+    env = dict(
+        os.environ,
+        ANTHROPIC_BASE_URL=base_url,
+        DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'bench.db')}",
+        REDIS_URL='redis://127.0.0.1:1',  # Nothing listens here; the breaker keeps PDFs in the session
+        SECRET_KEY='bench',
+        PORT=str(port)
+    )
+    log = open(log_path, 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--workers', str(workers),
+         '--bind', f'127.0.0.1:{port}', 'app:app'],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    app_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'gunicorn exited with {process.returncode}; see {log_path}')
+        try:
+            urllib.request.urlopen(f'{app_url}/health', timeout=2).read()
+            return process, app_url
+        except OSError:
+            time.sleep(0.25)
+    process.terminate()
+    raise SystemExit(f'app did not come up within 60s; see {log_path}')
+
+
+class VirtualUser:
+    def __init__(self, app_url, pdf_b64):
+        self.app_url = app_url
+        self.pdf_b64 = pdf_b64
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def post(self, path, payload):
+        request = urllib.request.Request(f'{self.app_url}{path}', data=json.dumps(payload).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=120) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError:
+            status = 0
+        return time.perf_counter() - start, status
+
+    def upload(self):
+        return self.post('/upload_pdf', {'pdf_data': f'data:application/pdf;base64,{self.pdf_b64}'})
+
+    def chat(self, criteria):
+        return self.post('/chat', {
+            'message': 'How long are evaluation records kept?',
+            'api_key': 'sk-ant-bench',
+            'evaluation_criteria': criteria
+        })
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_step(app_url, pdf_b64, n_criteria, concurrency, duration, warmup):
+    criteria = [{'type': 'groundedness' if i == 0 else f'criterion_{i}', 'prompt': ''} for i in range(n_criteria)]
+    results = []
+    uploads = []
+    lock = threading.Lock()
+    timing = {}
+
+    def start_clock():
+        # Runs once every user has uploaded, before any of them is released
+        timing['measure_from'] = time.monotonic() + warmup
+        timing['end'] = timing['measure_from'] + duration
+
+    start_barrier = threading.Barrier(concurrency + 1, action=start_clock)
+
+    def user_loop():
+        user = VirtualUser(app_url, pdf_b64)
+        upload = user.upload()
+        with lock:
+            uploads.append(upload)
+        start_barrier.wait()
+        while time.monotonic() < timing['end']:
+            latency, status = user.chat(criteria)
+            finished = time.monotonic()
+            if finished >= timing['measure_from'] and finished <= timing['end']:
+                with lock:
+                    results.append((latency, status))
+
+    threads = [threading.Thread(target=user_loop, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+
+    latencies = sorted(latency for latency, status in results if status == 200)
+    errors = sum(1 for _, status in results if status != 200)
+    upload_latencies = sorted(latency for latency, status in uploads if status == 200)
+    return {
+        'criteria': n_criteria,
+        'concurrency': concurrency,
+        'requests': len(results),
+        'errors': errors,
+        'rps': len(latencies) / duration,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'busy': sum(latency for latency, _ in results) / duration,
+        'upload_p50': percentile(upload_latencies, 0.50)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn sync workers')
+    parser.add_argument('--criteria', default='1,3,10', help='comma-separated criteria counts per /chat')
+    parser.add_argument('--concurrency', default='1,2,4,8,16', help='comma-separated virtual user counts')
+    parser.add_argument('--duration', type=float, default=10, help='measured seconds per step')
+    parser.add_argument('--warmup', type=float, default=2, help='unmeasured seconds at the start of each step')
+    parser.add_argument('--latency-ms', type=float, default=400)
+    parser.add_argument('--jitter-ms', type=float, default=150)
+    parser.add_argument('--output-tokens', type=int, default=300)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    config = FakeAnthropicConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                 output_tokens=args.output_tokens, error_rate=args.error_rate)
+    fake, base_url = start_fake_anthropic(config)
+    log_path = os.path.join(tempfile.gettempdir(), 'chateval_bench_gunicorn.log')
+    process, app_url = start_app(base_url, args.workers, log_path)
+    pdf_b64 = base64.b64encode(make_pdf(DOCUMENT_LINES)).decode()
+
+    print(f"app {app_url} ({args.workers} workers), fake API {base_url} "
+          f"({args.latency_ms:.0f}±{args.jitter_ms:.0f} ms, error rate {args.error_rate}), log {log_path}")
+    print(f"{'criteria':>8} {'users':>5} {'req':>6} {'err':>4} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'busy':>5} {'util':>5} {'api max':>7} {'upload':>7}")
+    results = []
+    try:
+        for n_criteria in [int(value) for value in args.criteria.split(',')]:
+            for concurrency in [int(value) for value in args.concurrency.split(',')]:
+                fake.stats.reset()
+                step = run_step(app_url, pdf_b64, n_criteria, concurrency, args.duration, args.warmup)
+                step['util'] = min(step['busy'] / args.workers, 1.0)
+                step['api_max_in_flight'] = fake.stats.max_in_flight
+                results.append(step)
+                print(f"{n_criteria:>8} {concurrency:>5} {step['requests']:>6} {step['errors']:>4} "
+                      f"{step['rps']:>7.2f} {step['p50'] * 1000:>8.0f} {step['p95'] * 1000:>8.0f} "
+                      f"{step['p99'] * 1000:>8.0f} {step['busy']:>5.1f} {step['util']:>5.2f} "
+                      f"{step['api_max_in_flight']:>7} {step['upload_p50'] * 1000:>6.0f}ms")
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        fake.shutdown()
+
+    by_criteria = {}
+    for step in results:
+        by_criteria.setdefault(step['criteria'], []).append(step)
+    for n_criteria, steps in by_criteria.items():
+        saturated = next((step for step in steps if step['util'] >= 0.9), None)
+        if saturated:
+            print(f"{n_criteria} criteria: workers saturated at {saturated['concurrency']} users, "
+                  f"{saturated['rps']:.2f} req/s")
+        else:
+            print(f"{n_criteria} criteria: not saturated; peak {max(s['rps'] for s in steps):.2f} req/s")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Benchmark the per-turn database writes done by app_with_auth.chat().
+
+Compares the original write path (separate session commit, one ORM object per
+row, read-modify-write of User.usage_count) with record_chat_turn(), which
+stages the whole turn as bulk inserts plus an atomic counter UPDATE and
+commits once.
+
+Usage:
+    python benchmarks/bench_chat_writes.py [--turns 2000] [--new-session-every 10]
+
+Runs against a throwaway SQLite file by default; set BENCH_DATABASE_URL to
+point it at Postgres instead.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmpdir = tempfile.mkdtemp(prefix='chateval_bench_')
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+)
+
+from sqlalchemy import event  # noqa: E402
+
+import app_with_auth as auth_app  # noqa: E402
+from app_with_auth import app, db, User, ChatSession, Message, Evaluation, UsageLog  # noqa: E402
+
+QUESTION = 'What does section 3 of the document say about retention?'
+ANSWER = 'Section 3 states that records are retained for **90 days**. ' * 10
+EVALUATION = 'Label: Grounded\nExplanation: The response cites the document directly.'
+
+
+def legacy_turn(user_id, session_id):
+    """The write path as it was before record_chat_turn()"""
+    user = db.session.get(User, user_id)  # what flask-login's user_loader does
+    chat_session = None
+    if session_id:
+        chat_session = ChatSession.query.filter_by(session_id=session_id, user_id=user_id).first()
+    if not chat_session:
+        chat_session = ChatSession(session_id=str(uuid.uuid4()), user_id=user_id)
+        db.session.add(chat_session)
+        db.session.commit()
+
+    db.session.add(Message(session_id=chat_session.id, role='user', content=QUESTION))
+    db.session.add(Message(session_id=chat_session.id, role='assistant', content=ANSWER))
+    db.session.add(Evaluation(session_id=chat_session.id, question=QUESTION, response=ANSWER,
+                              evaluation_result=EVALUATION))
+    user.usage_count += 1
+    db.session.add(UsageLog(user_id=user_id, action='chat', tokens_used=1000))
+    db.session.commit()
+    return chat_session.session_id
+
+
+def batched_turn(user_id, session_id):
+    """The write path used by chat() now"""
+    db.session.get(User, user_id)
+    chat_session = None
+    if session_id:
+        chat_session = ChatSession.query.filter_by(session_id=session_id, user_id=user_id).first()
+    if not chat_session:
+        chat_session = ChatSession(session_id=str(uuid.uuid4()), user_id=user_id)
+        db.session.add(chat_session)
+        db.session.flush()
+    auth_app.record_chat_turn(chat_session.id, user_id, QUESTION, ANSWER, EVALUATION, tokens_used=1000)
+    db.session.commit()
+    return chat_session.session_id
+
+
+def run(name, turn_fn, user_id, turns, new_session_every):
+    counts = {'commits': 0, 'statements': 0}
+
+    def on_commit(conn):
+        counts['commits'] += 1
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        counts['statements'] += 1
+
+    event.listen(db.engine, 'commit', on_commit)
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    session_id = None
+    start = time.perf_counter()
+    try:
+        for i in range(turns):
+            if i % new_session_every == 0:
+                session_id = None
+            session_id = turn_fn(user_id, session_id)
+            db.session.remove()
+    finally:
+        elapsed = time.perf_counter() - start
+        event.remove(db.engine, 'commit', on_commit)
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+
+    print(f"{name:<8} {turns / elapsed:>10.1f} turns/s {counts['commits'] / elapsed:>10.1f} commits/s "
+          f"{counts['commits'] / turns:>6.2f} commits/turn {counts['statements'] / turns:>6.2f} statements/turn")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--turns', type=int, default=2000)
+    parser.add_argument('--new-session-every', type=int, default=10,
+                        help='start a new chat session every N turns')
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(google_id='bench', email='bench@example.com', name='Bench', usage_count=0)
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+        print(f"database: {db.engine.url.render_as_string(hide_password=True)}")
+        run('before', legacy_turn, user_id, args.turns, args.new_session_every)
+        run('after', batched_turn, user_id, args.turns, args.new_session_every)
+
+        expected = 2 * args.turns
+        actual = db.session.get(User, user_id).usage_count
+        assert actual == expected, f'usage_count {actual} != {expected}'
+
+
+if __name__ == '__main__':
+    main()
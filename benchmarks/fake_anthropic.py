@@ -0,0 +1,194 @@
+"""Local stand-in for the Anthropic Messages API, for benchmarks and offline runs.
+
+Answers POST /v1/messages with a well-formed message after a configurable
+latency (plus random jitter), reports configurable token usage, and fails a
+configurable fraction of requests with 529 overloaded or 429 rate-limit
+errors. Point the app at it with ANTHROPIC_BASE_URL=http://127.0.0.1:<port>.
+
+Usage:
+    python benchmarks/fake_anthropic.py [--port 8787] [--latency-ms 400] [--jitter-ms 150]
+                                        [--output-tokens 300] [--error-rate 0.01]
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+JUDGE_REPLY = json.dumps({
+    'label': 'Grounded',
+    'explanation': 'The response restates facts that appear in the document context.'
+})
+
+# Fixed wording that starts the app's judge prompts (groundedness and generic criteria). Answer
+# prompts can contain words like "evaluation" from the document or the question, so match these exactly.
+JUDGE_PROMPT_MARKERS = ('You are evaluating whether an AI response', 'Evaluate this AI response based on')
+
+ANSWER_WORDS = ('The', 'document', 'states', 'that', '**records**', 'are', 'kept', 'for', '90', 'days', 'and',
+                'reviewed', 'quarterly.', '-', 'Retention', 'applies', 'to', 'all', 'evaluation', 'data.')
+
+
+class FakeAnthropicConfig:
+    def __init__(self, latency_ms=400, jitter_ms=150, input_tokens=None, output_tokens=300,
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after=1, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.input_tokens = input_tokens  # None -> estimate from the prompt length
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+
+class FakeAnthropicStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def enter(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def leave(self, error=False):
+        with self._lock:
+            self.in_flight -= 1
+            if error:
+                self.errors += 1
+
+    def reset(self):
+        with self._lock:
+            self.requests = self.errors = self.max_in_flight = 0
+
+    def to_dict(self):
+        return {'requests': self.requests, 'errors': self.errors, 'max_in_flight': self.max_in_flight}
+
+
+def _prompt_text(body):
+    parts = []
+    for message in body.get('messages', []):
+        content = message.get('content', '')
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(block.get('text', '') for block in content if isinstance(block, dict))
+    return '\n'.join(parts)
+
+
+def _answer_text(config, output_tokens):
+    words = [config.random.choice(ANSWER_WORDS) for _ in range(max(output_tokens * 3 // 4, 1))]
+    return ' '.join(words)
+
+
+class FakeAnthropicHandler(BaseHTTPRequestHandler):
+    server_version = 'fake-anthropic/1.0'
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, the body waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('request-id', f'req_{uuid.uuid4().hex[:24]}')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/v1/messages':
+            self._send_json(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': self.path}})
+            return
+        config = self.server.config
+        stats = self.server.stats
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        stats.enter()
+        error = False
+        try:
+            delay = config.latency_ms + config.random.uniform(-config.jitter_ms, config.jitter_ms)
+            time.sleep(max(delay, 0) / 1000)
+
+            roll = config.random.random()
+            if roll < config.error_rate:
+                error = True
+                self._send_json(529, {'type': 'error',
+                                      'error': {'type': 'overloaded_error', 'message': 'Overloaded'}})
+                return
+            if roll < config.error_rate + config.rate_limit_rate:
+                error = True
+                self._send_json(429, {'type': 'error',
+                                      'error': {'type': 'rate_limit_error', 'message': 'Rate limited'}},
+                                headers={'retry-after': str(config.retry_after)})
+                return
+
+            prompt = _prompt_text(body)
+            is_judge = any(marker in prompt for marker in JUDGE_PROMPT_MARKERS)
+            output_tokens = min(config.output_tokens, body.get('max_tokens', config.output_tokens))
+            text = JUDGE_REPLY if is_judge else _answer_text(config, output_tokens)
+            self._send_json(200, {
+                'id': f'msg_{uuid.uuid4().hex[:24]}',
+                'type': 'message',
+                'role': 'assistant',
+                'model': body.get('model', 'claude-3-haiku-20240307'),
+                'content': [{'type': 'text', 'text': text}],
+                'stop_reason': 'end_turn',
+                'stop_sequence': None,
+                'usage': {
+                    'input_tokens': config.input_tokens or max(len(prompt) // 4, 1),
+                    'output_tokens': output_tokens,
+                    'cache_creation_input_tokens': 0,
+                    'cache_read_input_tokens': 0
+                }
+            })
+        finally:
+            stats.leave(error)
+
+
+def start_fake_anthropic(config=None, host='127.0.0.1', port=0):
+    """Start the server on a background thread; returns (server, base_url)"""
+    server = ThreadingHTTPServer((host, port), FakeAnthropicHandler)
+    server.daemon_threads = True
+    server.config = config or FakeAnthropicConfig()
+    server.stats = FakeAnthropicStats()
+    threading.Thread(target=server.serve_forever, name='fake-anthropic', daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--latency-ms', type=float, default=400)
+    parser.add_argument('--jitter-ms', type=float, default=150)
+    parser.add_argument('--input-tokens', type=int, default=None, help='fixed input tokens (default: estimate)')
+    parser.add_argument('--output-tokens', type=int, default=300)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 529 overloaded replies')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of 429 replies')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = FakeAnthropicConfig(args.latency_ms, args.jitter_ms, args.input_tokens, args.output_tokens,
+                                 args.error_rate, args.rate_limit_rate, seed=args.seed)
+    server, base_url = start_fake_anthropic(config, args.host, args.port)
+    print(f"Fake Anthropic API listening on {base_url} (ANTHROPIC_BASE_URL={base_url})")
+    try:
+        while True:
+            time.sleep(5)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
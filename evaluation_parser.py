@@ -0,0 +1,115 @@
+"""Parse judge model output into (label, explanation).
+
+Judge prompts ask for a JSON object, but models still wrap it in code fences,
+add prose around it, or fall back to the older "Label: ... / Explanation: ..."
+text. parse_judge_output tries, in order: a JSON object anywhere in the text,
+"Label:"-style lines (tolerating markdown emphasis, bullets and casing), and
+finally a groundedness label at the very start of the text.
+
+Only the three groundedness labels (and known spellings of them) are
+accepted. Anything else - "Rating: 4/5", or prose such as "The answer is not
+fully grounded" - is treated as unknown rather than guessed at.
+"""
+import json
+import re
+
+GROUNDEDNESS_LABELS = ('Grounded', 'Partially Grounded', 'Not Grounded')
+
+# Alternate spellings judges produce -> canonical label
+_LABEL_ALIASES = {
+    'grounded': 'Grounded',
+    'fully grounded': 'Grounded',
+    'partially grounded': 'Partially Grounded',
+    'partly grounded': 'Partially Grounded',
+    'partial': 'Partially Grounded',
+    'not grounded': 'Not Grounded',
+    'ungrounded': 'Not Grounded',
+    'not_grounded': 'Not Grounded',
+    'partially_grounded': 'Partially Grounded'
+}
+
+_LABEL_KEYS = ('label', 'verdict', 'groundedness', 'rating', 'classification')
+_EXPLANATION_KEYS = ('explanation', 'reasoning', 'rationale', 'reason', 'justification')
+
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+_FIELD_RE = re.compile(
+    r'^[\s>*_#\-\d.)]*(?P<key>' + '|'.join(_LABEL_KEYS + _EXPLANATION_KEYS) + r')[\s*_]*[:\-][\s*_]*(?P<value>.*)$',
+    re.IGNORECASE | re.MULTILINE
+)
+_BARE_LABEL_RE = re.compile(r'\b(partially grounded|partly grounded|not grounded|ungrounded|grounded)\b', re.IGNORECASE)
+_DECORATION = ' \t*_`"\'[]().'
+
+
+def normalize_label(label):
+    """Canonical groundedness label if `label` is a known variant, else ''"""
+    if not label:
+        return ''
+    cleaned = label.strip(_DECORATION)
+    canonical = _LABEL_ALIASES.get(cleaned.lower())
+    if canonical is None:
+        # "Grounded - the answer cites..." -> "Grounded"
+        leading = _BARE_LABEL_RE.match(cleaned)
+        canonical = _LABEL_ALIASES[leading.group(1).lower()] if leading else ''
+    return canonical
+
+
+def _from_json(text):
+    match = _JSON_OBJECT_RE.search(text)
+    if not match:
+        return None
+    try:
+        data = json.loads(match.group(0))
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    fields = {str(key).lower(): value for key, value in data.items()}
+    label = next((normalize_label(fields[key]) for key in _LABEL_KEYS if isinstance(fields.get(key), str)), '')
+    if not label:
+        return None
+    explanation = next((fields[key] for key in _EXPLANATION_KEYS if isinstance(fields.get(key), str)), '')
+    return label, explanation.strip()
+
+
+def _from_fields(text):
+    label = None
+    explanation = None
+    matches = list(_FIELD_RE.finditer(text))
+    for index, match in enumerate(matches):
+        key = match.group('key').lower()
+        if key in _LABEL_KEYS and not label:
+            label = normalize_label(match.group('value'))
+        elif key in _EXPLANATION_KEYS and explanation is None:
+            # The explanation runs until the next recognised field
+            end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+            rest = text[match.start('value'):end]
+            explanation = ' '.join(line.strip() for line in rest.splitlines() if line.strip())
+    if not label:
+        return None
+    return label, (explanation or '').strip(' \t*_`"\'')
+
+
+def parse_judge_output(text):
+    """(label, explanation) from a judge response; ('', '') without a confident groundedness label"""
+    if not text:
+        return '', ''
+    for parse in (_from_json, _from_fields):
+        parsed = parse(text)
+        if parsed:
+            return parsed
+    # "Grounded. The response..." - but not a label merely mentioned mid-sentence
+    bare = _BARE_LABEL_RE.match(text.lstrip(_DECORATION + '#>\n'))
+    if bare:
+        return normalize_label(bare.group(1)), text.strip()
+    return '', ''
+
+
+def format_evaluation(label, explanation):
+    """Display text in the "Label: / Explanation:" layout the frontends parse"""
+    return f"Label: {label}\nExplanation: {explanation}"
+
+
+def display_evaluation(text):
+    """Judge output in the "Label: / Explanation:" layout if a groundedness label parses, else unchanged"""
+    label, explanation = parse_judge_output(text)
+    return format_evaluation(label, explanation) if label else text
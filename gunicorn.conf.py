@@ -12,9 +12,11 @@ worker_connections = 1000
 timeout = 120
 keepalive = 2
 
-# Restart workers after this many requests, to help prevent memory leaks
-max_requests = 1000
-max_requests_jitter = 50
+# Workers are recycled when they exceed MEMORY_BUDGET_MB (see post_request), not
+# after a fixed number of requests, so healthy workers keep warm caches and
+# connections. GUNICORN_MAX_REQUESTS restores count-based restarts if needed.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 20
 
 # Logging
 accesslog = '-'
@@ -34,4 +36,24 @@ tmp_upload_dir = None
 
 # SSL (optional, Render handles this)
 keyfile = None
-certfile = None
\ No newline at end of file
+certfile = None
+
+# Server hooks
+def post_request(worker, req, environ, resp):
+    """Recycle the worker once its RSS exceeds the memory budget"""
+    from memory_budget import recycle_if_over_budget
+    recycle_if_over_budget(worker)  # Logs the reason with the structure sizes
+
+def worker_exit(server, worker):
+    """Flush conversations still waiting in the write-behind queue, then queued log records"""
+    try:
+        from app import chat_persistence
+    except ImportError:
+        pass
+    else:
+        chat_persistence.close()
+    try:
+        from structured_logging import stop_logging
+    except ImportError:
+        return
+    stop_logging()
@@ -0,0 +1,194 @@
+"""Liveness and readiness checks backed by a background dependency prober.
+
+/healthz only proves the worker can serve a request; it touches nothing
+else. /readyz reports the results of DependencyProber, which checks each
+dependency from a background thread every PROBE_INTERVAL seconds, so
+load-balancer probes never reach the database or Redis themselves and a
+slow dependency cannot make the probe time out. A result older than
+PROBE_TTL counts as failed: if the prober itself is stuck on a hanging
+dependency the worker stops reporting ready.
+
+Only critical checks decide readiness. Redis is optional (PDFs fall back
+to in-process storage), so it is reported but never makes a worker unready.
+"""
+import logging
+import os
+import threading
+import time
+
+from flask import jsonify
+from sqlalchemy import text
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+DEPENDENCY_UP = registry.gauge(
+    'chat_eval_dependency_up', 'Last background probe of a dependency succeeded (1) or failed (0)', ('dependency',))
+DEPENDENCY_PROBE_SECONDS = registry.gauge(
+    'chat_eval_dependency_probe_seconds', 'Duration of the last background probe', ('dependency',))
+DB_POOL_CONNECTIONS = registry.gauge(
+    'chat_eval_db_pool_connections', 'Database pool connections by state', ('state',))
+
+
+def db_pool_stats(engine):
+    """Checked-out/idle/overflow counts for a SQLAlchemy QueuePool (other pools report their class only)"""
+    pool = engine.pool
+    stats = {'class': type(pool).__name__}
+    for name in ('size', 'checkedout', 'checkedin', 'overflow'):
+        method = getattr(pool, name, None)
+        if callable(method):
+            stats[name] = method()
+    return stats
+
+
+def database_check(app, db):
+    def check():
+        with app.app_context():
+            with db.engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+    return check
+
+
+def redis_check(redis_pool):
+    def check():
+        status = redis_pool.status()
+        if status not in ('healthy', 'not configured'):
+            raise RuntimeError(status)
+        return status
+    return check
+
+
+def redis_ping_check(client):
+    """Check for apps that hold a plain redis client (None when Redis was unavailable at startup)"""
+    def check():
+        if client is None:
+            return 'not configured'
+        client.ping()
+        return 'healthy'
+    return check
+
+
+def health_status(checks, name):
+    """'healthy' / 'unhealthy' (or the check's detail) for one result of DependencyProber.snapshot()"""
+    result = checks[name]
+    if not result['ok']:
+        return 'unhealthy'
+    return result.get('detail', 'healthy')
+
+
+class DependencyProber:
+    """Run dependency checks on a background thread and cache the results.
+
+    `checks` maps a name to (callable, critical). A check passes unless it
+    raises; its return value, if any, is reported as `detail`. Like
+    WriteBehindQueue, the thread is started lazily in each process.
+    """
+
+    def __init__(self, checks, interval=5.0, ttl=15.0):
+        self.checks = checks
+        self.interval = interval
+        self.ttl = ttl
+        self.results = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._first_round = threading.Event()
+
+    @classmethod
+    def from_env(cls, checks):
+        return cls(
+            checks,
+            interval=float(os.environ.get('PROBE_INTERVAL', 5)),
+            ttl=float(os.environ.get('PROBE_TTL', 15))
+        )
+
+    def ensure_started(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                # Results inherited from the parent describe its connections, not ours
+                self.results = {}
+                self._first_round = threading.Event()
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='dependency-prober', daemon=True)
+            self._thread.start()
+
+    def probe_once(self):
+        for name, (check, critical) in self.checks.items():
+            start = time.perf_counter()
+            result = {'critical': critical}
+            try:
+                detail = check()
+                result['ok'] = True
+                if detail is not None:
+                    result['detail'] = detail
+            except Exception as e:
+                result['ok'] = False
+                result['error'] = str(e)[:200]
+                if self.results.get(name, {}).get('ok', True):
+                    logger.warning('Dependency check failed: %s', name, extra={'error': result['error']})
+            elapsed = time.perf_counter() - start
+            result['latency_ms'] = round(elapsed * 1000, 1)
+            result['checked_at'] = time.time()
+            self.results[name] = result
+            DEPENDENCY_UP.set(1 if result['ok'] else 0, dependency=name)
+            DEPENDENCY_PROBE_SECONDS.set(round(elapsed, 4), dependency=name)
+        self._first_round.set()
+
+    def _run(self):
+        while True:
+            self.probe_once()
+            time.sleep(self.interval)
+
+    def snapshot(self, wait=1.0):
+        """Cached results with their age; stale or missing results count as failed"""
+        self.ensure_started()
+        self._first_round.wait(wait)
+        now = time.time()
+        checks = {}
+        ready = True
+        for name, (_, critical) in self.checks.items():
+            result = dict(self.results.get(name) or {'critical': critical, 'ok': False, 'error': 'not probed yet'})
+            checked_at = result.pop('checked_at', None)
+            if checked_at is not None:
+                result['age_seconds'] = round(now - checked_at, 1)
+                if now - checked_at > self.ttl:
+                    result['ok'] = False
+                    result['error'] = f'stale: last probe {result["age_seconds"]}s ago'
+            if critical and not result['ok']:
+                ready = False
+            checks[name] = result
+        return ready, checks
+
+
+def init_health(app, prober, pools):
+    """Add /healthz (liveness) and /readyz (readiness) routes.
+
+    `pools` returns connection pool statistics to include in /readyz; it
+    must not do any I/O.
+    """
+    started = time.time()
+
+    @app.route('/healthz')
+    def healthz():
+        return jsonify({'status': 'ok', 'pid': os.getpid(), 'uptime_seconds': round(time.time() - started)})
+
+    @app.route('/readyz')
+    def readyz():
+        ready, checks = prober.snapshot()
+        body = {'status': 'ready' if ready else 'not_ready', 'checks': checks, 'pools': pools(), 'pid': os.getpid()}
+        return jsonify(body), 200 if ready else 503
+
+    def collect_pool_gauges():
+        database = pools().get('database', {})
+        for state in ('checkedout', 'checkedin', 'overflow'):
+            if state in database:
+                DB_POOL_CONNECTIONS.set(database[state], state=state)
+
+    registry.add_collector(collect_pool_gauges)
+    return prober
@@ -0,0 +1,219 @@
+"""Streaming export of EvaluationHistory query results.
+
+Rows are read from the database in batches (server-side cursor on Postgres)
+and encoded into output chunks as they arrive, so worker memory stays flat
+regardless of how many rows are exported. Parquet and Arrow IPC output
+(optional, needs pyarrow) is written one record batch / row group at a time.
+"""
+import csv
+import io
+import json
+import zlib
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Columnar export is optional
+    pa = None
+    pq = None
+
+CSV_FIELDS = [
+    'id', 'timestamp', 'question', 'response', 'groundedness_level',
+    'evaluation_explanation', 'pdf_filename', 'improved_response'
+]
+
+# Bytes of encoded output to collect before handing a chunk to the server
+CHUNK_SIZE = 64 * 1024
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'json': ('application/json', 'json')
+}
+
+# Columnar formats for analytics; need pyarrow
+COLUMNAR_FORMATS = {
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows')
+}
+
+# Low-cardinality columns stored dictionary-encoded
+DICTIONARY_COLUMNS = ['groundedness_level', 'pdf_filename']
+
+COLUMNAR_FIELDS = [
+    'id', 'session_id', 'timestamp', 'question', 'response', 'evaluation',
+    'groundedness_level', 'evaluation_explanation', 'pdf_filename',
+    'improved_response', 'improved_evaluation'
+]
+
+
+def iter_records(query, batch_size=500):
+    """Iterate query results in batches without loading the whole result set"""
+    return query.yield_per(batch_size)
+
+
+def _buffered(pieces):
+    """Join small string pieces into CHUNK_SIZE-ish encoded chunks"""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buffer).encode()
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def _csv_pieces(records):
+    line = io.StringIO()
+    writer = csv.DictWriter(line, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    yield line.getvalue()
+    for record in records:
+        line.seek(0)
+        line.truncate()
+        writer.writerow({
+            'id': record.id,
+            'timestamp': record.timestamp.isoformat(),
+            'question': record.question,
+            'response': record.response,
+            'groundedness_level': record.groundedness_level,
+            'evaluation_explanation': record.evaluation_explanation,
+            'pdf_filename': record.pdf_filename,
+            'improved_response': record.improved_response
+        })
+        yield line.getvalue()
+
+
+def _ndjson_pieces(records):
+    for record in records:
+        yield json.dumps(record.to_dict()) + '\n'
+
+
+def _json_array_pieces(records):
+    yield '['
+    separator = '\n'
+    for record in records:
+        yield separator + json.dumps(record.to_dict())
+        separator = ',\n'
+    yield '\n]\n'
+
+
+def export_chunks(records, format):
+    """Encoded output chunks for the given export format ('csv', 'ndjson' or 'json')"""
+    pieces = {
+        'csv': _csv_pieces,
+        'ndjson': _ndjson_pieces,
+        'json': _json_array_pieces
+    }[format](records)
+    return _buffered(pieces)
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip-compress a chunk stream on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def columnar_available():
+    return pa is not None
+
+
+def arrow_schema():
+    dictionary_string = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ('id', pa.int64()),
+        ('session_id', pa.string()),
+        ('timestamp', pa.timestamp('us')),
+        ('question', pa.string()),
+        ('response', pa.string()),
+        ('evaluation', pa.string()),
+        ('groundedness_level', dictionary_string),
+        ('evaluation_explanation', pa.string()),
+        ('pdf_filename', dictionary_string),
+        ('improved_response', pa.string()),
+        ('improved_evaluation', pa.string())
+    ])
+
+
+def record_batches(records, schema, batch_size):
+    """Group ORM records into Arrow record batches of up to batch_size rows"""
+    columns = {name: [] for name in COLUMNAR_FIELDS}
+    count = 0
+
+    def flush():
+        arrays = []
+        for field in schema:
+            values = columns[field.name]
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, type=field.type))
+            values.clear()
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    for record in records:
+        for name in COLUMNAR_FIELDS:
+            columns[name].append(getattr(record, name))
+        count += 1
+        if count == batch_size:
+            yield flush()
+            count = 0
+    if count:
+        yield flush()
+
+
+class _ChunkSink:
+    """Write-only file object that hands back whatever was written since the last drain"""
+
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._buffer.write(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+
+def columnar_chunks(records, format, batch_size=10000):
+    """Stream records as Parquet (one row group per batch) or an Arrow IPC stream"""
+    schema = arrow_schema()
+    sink = _ChunkSink()
+    if format == 'parquet':
+        writer = pq.ParquetWriter(sink, schema, compression='zstd', use_dictionary=DICTIONARY_COLUMNS)
+        write = lambda batch: writer.write_batch(batch, row_group_size=batch_size)
+    else:
+        writer = pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+        write = writer.write_batch
+
+    for batch in record_batches(records, schema, batch_size):
+        write(batch)
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+    writer.close()
+    yield sink.drain()
@@ -0,0 +1,301 @@
+"""Retention for EvaluationHistory: delete old rows in small, throttled batches.
+
+Rows are selected by primary key in keyset order and deleted `batch_size` at a
+time, each batch in its own short transaction with a pause in between, so a
+large purge never holds long locks or starves request traffic.
+"""
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, text
+
+from models import db, Document, EvaluationHistory
+from pagination import keyset_before
+
+try:
+    import fcntl
+except ImportError:  # Windows: no gunicorn workers to coordinate
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy:
+    """What to keep: rows newer than `max_age_days`, and the newest `max_rows_per_session` per session"""
+
+    def __init__(self, max_age_days=None, max_rows_per_session=None):
+        self.max_age_days = max_age_days
+        self.max_rows_per_session = max_rows_per_session
+
+    @classmethod
+    def from_env(cls):
+        max_age_days = os.getenv('HISTORY_RETENTION_DAYS')
+        max_rows_per_session = os.getenv('HISTORY_RETENTION_PER_SESSION')
+        return cls(
+            max_age_days=int(max_age_days) if max_age_days else None,
+            max_rows_per_session=int(max_rows_per_session) if max_rows_per_session else None
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.max_age_days or self.max_rows_per_session)
+
+    def to_dict(self):
+        return {'max_age_days': self.max_age_days, 'max_rows_per_session': self.max_rows_per_session}
+
+
+def _delete_in_batches(condition, batch_size, pause, dry_run):
+    """Delete rows matching `condition` by ascending id; returns (rows, batches)"""
+    deleted = 0
+    batches = 0
+    last_id = 0
+    while True:
+        ids = db.session.scalars(
+            select(EvaluationHistory.id)
+            .where(condition, EvaluationHistory.id > last_id)
+            .order_by(EvaluationHistory.id)
+            .limit(batch_size)
+        ).all()
+        if not ids:
+            break
+        last_id = ids[-1]
+        if not dry_run:
+            db.session.execute(
+                EvaluationHistory.__table__.delete().where(EvaluationHistory.id.in_(ids))
+            )
+            db.session.commit()
+        deleted += len(ids)
+        batches += 1
+        if len(ids) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return deleted, batches
+
+
+def _sessions_over_limit(max_rows, live):
+    return db.session.execute(
+        select(EvaluationHistory.session_id)
+        .where(live)
+        .group_by(EvaluationHistory.session_id)
+        .having(db.func.count(EvaluationHistory.id) > max_rows)
+    ).scalars().all()
+
+
+def _oldest_kept(session_id, max_rows, live):
+    """(timestamp, id) of the oldest row that survives the per-session limit"""
+    return db.session.execute(
+        select(EvaluationHistory.timestamp, EvaluationHistory.id)
+        .where(EvaluationHistory.session_id == session_id, live)
+        .order_by(EvaluationHistory.timestamp.desc(), EvaluationHistory.id.desc())
+        .offset(max_rows - 1)
+        .limit(1)
+    ).first()
+
+
+def _delete_orphan_documents(batch_size, dry_run):
+    """Remove documents that no history row references any more"""
+    referenced = select(EvaluationHistory.id).where(EvaluationHistory.document_id == Document.id)
+    deleted = 0
+    last_id = 0
+    while True:
+        ids = db.session.scalars(
+            select(Document.id)
+            .where(Document.id > last_id, ~referenced.exists())
+            .order_by(Document.id)
+            .limit(batch_size)
+        ).all()
+        if not ids:
+            break
+        last_id = ids[-1]
+        if not dry_run:
+            db.session.execute(Document.__table__.delete().where(Document.id.in_(ids)))
+            db.session.commit()
+        deleted += len(ids)
+    return deleted
+
+
+def _maintain(vacuum, analyze):
+    """Run VACUUM / ANALYZE outside a transaction, as both databases require"""
+    dialect = db.engine.dialect.name
+    statements = []
+    if dialect == 'postgresql':
+        if vacuum:
+            statements.append('VACUUM (ANALYZE) evaluation_history' if analyze else 'VACUUM evaluation_history')
+            statements.append('VACUUM document')
+        elif analyze:
+            statements.append('ANALYZE evaluation_history')
+    elif dialect == 'sqlite':
+        if vacuum:
+            statements.append('VACUUM')
+        if analyze:
+            statements.append('ANALYZE')
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+    return statements
+
+
+def _sqlite_file_bytes():
+    if db.engine.dialect.name != 'sqlite':
+        return None
+    with db.engine.connect() as conn:
+        page_count = conn.exec_driver_sql('PRAGMA page_count').scalar()
+        page_size = conn.exec_driver_sql('PRAGMA page_size').scalar()
+    return page_count * page_size
+
+
+def purge_history(policy, batch_size=500, pause=0.1, vacuum=False, analyze=False, dry_run=False):
+    """Apply a retention policy; returns a report of what was (or would be) deleted"""
+    started = time.monotonic()
+    size_before = _sqlite_file_bytes()
+    report = {
+        'policy': policy.to_dict(),
+        'dry_run': dry_run,
+        'deleted_by_age': 0,
+        'deleted_by_session_limit': 0,
+        'sessions_trimmed': 0,
+        'deleted_documents': 0,
+        'batches': 0
+    }
+
+    # Rows the age rule keeps. The per-session rule only looks at these, so a dry run (where
+    # the age pass deletes nothing) neither counts a row twice nor trims sessions by rows
+    # that a real run would already have removed.
+    live = db.true()
+    if policy.max_age_days:
+        cutoff = datetime.utcnow() - timedelta(days=policy.max_age_days)
+        deleted, batches = _delete_in_batches(EvaluationHistory.timestamp < cutoff, batch_size, pause, dry_run)
+        report['deleted_by_age'] = deleted
+        report['batches'] += batches
+        live = EvaluationHistory.timestamp >= cutoff
+
+    if policy.max_rows_per_session:
+        for session_id in _sessions_over_limit(policy.max_rows_per_session, live):
+            oldest_kept = _oldest_kept(session_id, policy.max_rows_per_session, live)
+            if oldest_kept is None:
+                continue
+            condition = db.and_(
+                live,
+                EvaluationHistory.session_id == session_id,
+                keyset_before(EvaluationHistory.timestamp, EvaluationHistory.id, *oldest_kept)
+            )
+            deleted, batches = _delete_in_batches(condition, batch_size, pause, dry_run)
+            report['deleted_by_session_limit'] += deleted
+            report['sessions_trimmed'] += 1
+            report['batches'] += batches
+
+    report['deleted_documents'] = _delete_orphan_documents(batch_size, dry_run)
+    report['deleted_rows'] = report['deleted_by_age'] + report['deleted_by_session_limit']
+
+    if not dry_run and (vacuum or analyze):
+        report['maintenance'] = _maintain(vacuum, analyze)
+        size_after = _sqlite_file_bytes()
+        if size_before is not None:
+            report['bytes_reclaimed'] = size_before - size_after
+
+    report['seconds'] = round(time.monotonic() - started, 3)
+    return report
+
+
+class RetentionJob:
+    """Run purge_history periodically from a background thread.
+
+    Like WriteBehindQueue, the thread is started lazily in each process, but
+    only one process on the host purges: each thread tries to take an
+    exclusive lock on `lock_path` and the one that gets it keeps it for the
+    life of its process. The others retry every `interval`, so another
+    worker takes over if that process exits. With several hosts sharing a
+    database, leave HISTORY_RETENTION_INTERVAL unset and run the
+    purge-history command from cron on one of them instead.
+
+    `on_purged(report)` is called after every run that deleted something,
+    e.g. to invalidate caches.
+    """
+
+    def __init__(self, app, policy, interval=3600, on_purged=None, lock_path=None, **purge_options):
+        self.app = app
+        self.policy = policy
+        self.interval = interval
+        self.on_purged = on_purged
+        self.lock_path = lock_path or os.path.join(tempfile.gettempdir(), 'chat_eval_history_retention.lock')
+        self.purge_options = purge_options
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._lock_file = None
+        self._stopping = threading.Event()
+        self.runs = 0
+        self.failures = 0
+        self.last_report = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0 and self.policy.enabled
+
+    @property
+    def leader(self):
+        """Whether this process is the one that purges"""
+        return self._lock_file is not None and self._pid == os.getpid()
+
+    def ensure_started(self):
+        if not self.enabled:
+            return
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                # A lock inherited from the parent is the parent's
+                self._lock_file = None
+            self._pid = pid
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='history-retention', daemon=True)
+            self._thread.start()
+
+    def _acquire_leadership(self):
+        if self._lock_file is not None:
+            return True
+        if fcntl is None:
+            self._lock_file = True
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file  # Held until the process exits
+        logger.info('History retention runs in this process', extra={'lock_path': self.lock_path})
+        return True
+
+    def run_once(self):
+        with self.app.app_context():
+            try:
+                report = purge_history(self.policy, **self.purge_options)
+            except Exception:
+                db.session.rollback()
+                self.failures += 1
+                logger.exception('History retention run failed')
+                return None
+        self.runs += 1
+        self.last_report = report
+        if report['deleted_rows'] and self.on_purged:
+            self.on_purged(report)
+        return report
+
+    def _run(self):
+        while True:
+            if self._acquire_leadership():
+                self.run_once()
+            if self._stopping.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stopping.set()
@@ -0,0 +1,185 @@
+"""Full-text search over EvaluationHistory question/response text.
+
+SQLite uses an external-content FTS5 table kept in sync by triggers, created
+here on first use; Postgres uses a generated tsvector column with a GIN index,
+added by the 4e9a1c7b2d58 migration (flask db upgrade -d migrations_history)
+and only detected here. Any other database, a SQLite build without FTS5 or a
+Postgres database that has not been migrated falls back to LIKE matching.
+"""
+import logging
+import re
+
+from markupsafe import escape
+from sqlalchemy import func, inspect, literal_column, table, column, select, text
+
+from models import db, EvaluationHistory
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'evaluation_history_fts'
+
+SQLITE_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        question, response,
+        content='evaluation_history', content_rowid='id',
+        tokenize='porter unicode61'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON evaluation_history BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, question, response) VALUES (new.id, new.question, new.response);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON evaluation_history BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, question, response)
+        VALUES ('delete', old.id, old.question, old.response);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF question, response ON evaluation_history BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, question, response)
+        VALUES ('delete', old.id, old.question, old.response);
+        INSERT INTO {FTS_TABLE}(rowid, question, response) VALUES (new.id, new.question, new.response);
+    END"""
+]
+
+SNIPPET_START = '<mark>'
+SNIPPET_END = '</mark>'
+# The database marks matches with these; they are swapped for SNIPPET_START/END after HTML-escaping the text
+_MATCH_START = '\x02'
+_MATCH_END = '\x03'
+
+# Engines whose search index has been checked/installed in this process -> backend name
+_backends = {}
+
+
+def install_search_index(engine):
+    """Create the SQLite full-text index if missing, or detect the migrated Postgres one; return the backend used"""
+    dialect = engine.dialect.name
+    with engine.begin() as conn:
+        if dialect == 'sqlite':
+            exists = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': FTS_TABLE}
+            ).first()
+            try:
+                for statement in SQLITE_DDL:
+                    conn.execute(text(statement))
+            except Exception as e:
+                logger.warning('FTS5 not available, falling back to LIKE search: %s', e)
+                return 'like'
+            if not exists:
+                # Index rows written before the FTS table existed
+                conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+            return 'fts5'
+        if dialect == 'postgresql':
+            columns = {col['name'] for col in inspect(conn).get_columns('evaluation_history')}
+            if 'search_vector' not in columns:
+                logger.warning('evaluation_history.search_vector is missing, falling back to LIKE search; '
+                               'run flask db upgrade -d migrations_history')
+                return 'like'
+            return 'tsvector'
+    return 'like'
+
+
+def search_backend(engine):
+    """Backend for this engine, checked (and on SQLite installed) on first use"""
+    key = str(engine.url)
+    if key not in _backends:
+        _backends[key] = install_search_index(engine)
+    return _backends[key]
+
+
+def fts5_query(term):
+    """Turn free text into a safe FTS5 query: quoted terms ANDed, last one as a prefix"""
+    tokens = re.findall(r'\w+', term)
+    if not tokens:
+        return None
+    quoted = [f'"{token}"' for token in tokens]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def apply_search(query, term, ranked=True):
+    """Restrict an EvaluationHistory query to rows matching `term`.
+
+    Returns (query, is_ranked). When is_ranked is True the query yields
+    (EvaluationHistory, rank) tuples ordered best match first. Pass
+    ranked=False to get only the filter, e.g. for counting.
+    """
+    backend = search_backend(db.engine)
+
+    if backend == 'fts5':
+        match = fts5_query(term)
+        if match:
+            fts = table(FTS_TABLE, column('rowid'))
+            fts_ref = literal_column(FTS_TABLE)
+            if not ranked:
+                matching_ids = select(fts.c.rowid).where(fts_ref.op('MATCH')(match))
+                return query.filter(EvaluationHistory.id.in_(matching_ids)), False
+            # Rank inside a subquery so SQLite drives the join from the FTS index
+            matches = select(
+                fts.c.rowid.label('id'),
+                func.bm25(fts_ref, 2.0, 1.0).label('rank')  # Weight question matches above response matches
+            ).where(fts_ref.op('MATCH')(match)).subquery()
+            query = query.join(matches, matches.c.id == EvaluationHistory.id)\
+                         .add_columns(matches.c.rank)\
+                         .order_by(matches.c.rank, EvaluationHistory.id.desc())
+            return query, True
+
+    if backend == 'tsvector':
+        tsquery = func.websearch_to_tsquery('english', term)
+        vector = literal_column('evaluation_history.search_vector')
+        query = query.filter(vector.op('@@')(tsquery))
+        if not ranked:
+            return query, False
+        rank = func.ts_rank_cd(vector, tsquery)
+        query = query.add_columns(rank.label('rank'))\
+                     .order_by(rank.desc(), EvaluationHistory.id.desc())
+        return query, True
+
+    query = query.filter(
+        db.or_(
+            EvaluationHistory.question.contains(term),
+            EvaluationHistory.response.contains(term)
+        )
+    )
+    return query, False
+
+
+def highlight(snippet):
+    """HTML-escape a snippet from the database, then turn its match markers into <mark> tags"""
+    if snippet is None:
+        return None
+    return str(escape(snippet)).replace(_MATCH_START, SNIPPET_START).replace(_MATCH_END, SNIPPET_END)
+
+
+def search_snippets(ids, term):
+    """Highlighted snippets for the given rows, computed only for the page being returned.
+
+    The snippets are safe to insert as HTML: the row text is escaped and only
+    the <mark> tags around matches are markup.
+    """
+    if not ids:
+        return {}
+    backend = search_backend(db.engine)
+
+    if backend == 'fts5':
+        match = fts5_query(term)
+        if not match:
+            return {}
+        fts = table(FTS_TABLE, column('rowid'))
+        fts_ref = literal_column(FTS_TABLE)
+        rows = db.session.execute(
+            select(fts.c.rowid, func.snippet(fts_ref, -1, _MATCH_START, _MATCH_END, '…', 16))
+            .where(fts_ref.op('MATCH')(match), fts.c.rowid.in_(ids))
+        )
+        return {row_id: highlight(snippet) for row_id, snippet in rows}
+
+    if backend == 'tsvector':
+        rows = db.session.execute(
+            select(EvaluationHistory.id, func.ts_headline(
+                'english',
+                EvaluationHistory.question + ' ' + EvaluationHistory.response,
+                func.websearch_to_tsquery('english', term),
+                f'StartSel="{_MATCH_START}", StopSel="{_MATCH_END}", MaxFragments=2, MaxWords=20'
+            )).where(EvaluationHistory.id.in_(ids))
+        )
+        return {row_id: highlight(snippet) for row_id, snippet in rows}
+
+    return {}
@@ -0,0 +1,83 @@
+import threading
+
+from models import db, EvaluationHistory
+from ttl_cache import TTLCache
+
+GROUNDEDNESS_LEVELS = {
+    'Grounded': 'grounded',
+    'Partially Grounded': 'partially_grounded',
+    'Not Grounded': 'not_grounded'
+}
+
+
+def history_stats_query(session_id=None):
+    """(groundedness_level, total, improved) rows for one session, or all sessions"""
+    query = db.session.query(
+        EvaluationHistory.groundedness_level,
+        db.func.count(EvaluationHistory.id),
+        db.func.count(EvaluationHistory.improved_response)  # COUNT(col) skips NULLs
+    )
+    if session_id:
+        query = query.filter(EvaluationHistory.session_id == session_id)
+    return query.group_by(EvaluationHistory.groundedness_level)
+
+
+def compute_history_stats(session_id=None):
+    """Count evaluations per groundedness level and improved rows in one GROUP BY pass"""
+    counts = {'total': 0, 'improved': 0, 'levels': {}}
+    for level, total, improved in history_stats_query(session_id):
+        counts['total'] += total
+        counts['improved'] += improved
+        counts['levels'][level] = total
+    return counts
+
+
+class HistoryStatsCache:
+    """Per-session stats that are computed once and then updated in place on writes.
+
+    Each worker has its own cache and only sees its own writes, so entries
+    expire after a few seconds: a dashboard polling through several workers
+    then gets counts at most `ttl` seconds old from any of them, and the one
+    GROUP BY that refreshes an entry is cheap.
+    """
+
+    def __init__(self, ttl=5):
+        self._cache = TTLCache(ttl)
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        counts = self._cache.get(session_id)
+        if counts is None:
+            counts = compute_history_stats(session_id)
+            self._cache.set(session_id, counts)
+        with self._lock:
+            return {'total': counts['total'], 'improved': counts['improved'], 'levels': dict(counts['levels'])}
+
+    def record(self, session_id, level=None, total=0, improved=0):
+        """Apply a delta to the cached session entry and the all-sessions entry, if cached"""
+        with self._lock:
+            for key in (session_id, None):
+                counts = self._cache.get(key)
+                if counts is None:
+                    continue
+                counts['total'] += total
+                counts['improved'] += improved
+                if total:
+                    counts['levels'][level] = counts['levels'].get(level, 0) + total
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def stats_response(counts):
+    """Shape cached counts into the /history/stats JSON payload"""
+    total = counts['total']
+    response = {'total_evaluations': total}
+    for level, key in GROUNDEDNESS_LEVELS.items():
+        response[key] = counts['levels'].get(level, 0)
+    improvement_rate = (counts['improved'] / total * 100) if total > 0 else 0
+    response['improvement_rate'] = round(improvement_rate, 2)
+    return response
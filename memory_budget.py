@@ -0,0 +1,117 @@
+"""Per-worker memory telemetry and budget-based recycling.
+
+`monitor` reports the worker's resident set size and the size of the
+in-process structures the app registers with `monitor.track(name, fn)`,
+where fn returns {'items': n, 'bytes': approximate size}. The figures are
+exported as gauges at /metrics.
+
+gunicorn.conf.py calls `monitor.over_budget()` after every request. Once RSS
+exceeds MEMORY_BUDGET_MB the worker is recycled: gunicorn lets it finish the
+current request and starts a fresh one, and the reason is logged with the
+structure sizes so the growth can be traced. Healthy workers are no longer
+restarted after a fixed number of requests, so their caches and
+connections stay warm.
+"""
+import logging
+import os
+import resource
+import sys
+import threading
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+WORKER_RSS = registry.gauge('chat_eval_worker_rss_bytes', 'Resident set size of the worker process')
+WORKER_BUDGET = registry.gauge('chat_eval_worker_memory_budget_bytes', 'RSS above which the worker is recycled')
+STRUCTURE_ITEMS = registry.gauge('chat_eval_structure_items', 'Entries in an in-process structure', ('structure',))
+STRUCTURE_BYTES = registry.gauge(
+    'chat_eval_structure_bytes', 'Approximate size of an in-process structure', ('structure',))
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def rss_bytes():
+    """Current RSS from /proc; where that is unavailable, the peak RSS from getrusage"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def mapping_size(mapping):
+    """{'items', 'bytes'} for a dict of strings or bytes, counting the dict and its values"""
+    values = list(mapping.values())
+    return {'items': len(values), 'bytes': sys.getsizeof(mapping) + sum(sys.getsizeof(value) for value in values)}
+
+
+class MemoryMonitor:
+    def __init__(self, budget_bytes=0):
+        self.budget_bytes = budget_bytes
+        self._structures = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(budget_bytes=int(float(os.environ.get('MEMORY_BUDGET_MB', 400)) * 1024 * 1024))
+
+    def track(self, name, size):
+        """Report `size()` (returning {'items', 'bytes'}) as the in-process structure `name`"""
+        with self._lock:
+            self._structures[name] = size
+
+    def structures(self):
+        with self._lock:
+            structures = list(self._structures.items())
+        sizes = {}
+        for name, size in structures:
+            try:
+                sizes[name] = size()
+            except Exception:
+                logger.exception('Measuring %s failed', name)
+        return sizes
+
+    def snapshot(self):
+        return {
+            'pid': os.getpid(),
+            'rss_bytes': rss_bytes(),
+            'budget_bytes': self.budget_bytes or None,
+            'structures': self.structures()
+        }
+
+    def over_budget(self):
+        """The reason this worker should be recycled, or None while it is within budget"""
+        if not self.budget_bytes:
+            return None
+        rss = rss_bytes()
+        if rss <= self.budget_bytes:
+            return None
+        return f'rss {rss / 2**20:.0f} MiB exceeds budget {self.budget_bytes / 2**20:.0f} MiB'
+
+    def collect(self):
+        WORKER_RSS.set(rss_bytes())
+        if self.budget_bytes:
+            WORKER_BUDGET.set(self.budget_bytes)
+        for name, size in self.structures().items():
+            STRUCTURE_ITEMS.set(size.get('items', 0), structure=name)
+            if 'bytes' in size:
+                STRUCTURE_BYTES.set(size['bytes'], structure=name)
+
+
+monitor = MemoryMonitor.from_env()
+registry.add_collector(monitor.collect)
+
+
+def recycle_if_over_budget(worker):
+    """gunicorn post_request helper: stop `worker` after this request if it is over budget"""
+    reason = monitor.over_budget()
+    if reason is None or not worker.alive:
+        return None
+    worker.alive = False
+    logger.warning('Recycling worker: %s', reason, extra=monitor.snapshot())
+    return reason
@@ -0,0 +1,297 @@
+"""Lightweight in-process metrics: spans, histograms and counters.
+
+`span('answer')` times a block of work and records it in a per-stage
+histogram, labelled with the route being served (and optionally the
+evaluation criterion). `init_metrics(app)` times whole requests and the
+session load/save, adds a Server-Timing header listing the request's spans,
+and serves everything in the Prometheus text format at /metrics.
+
+/metrics includes model spend and token counts, so it requires
+`Authorization: Bearer <METRICS_TOKEN>` (Prometheus' `authorization`
+scrape setting). Without METRICS_TOKEN it only answers requests from
+localhost.
+
+Each observation is a bisect plus a few additions under a lock, so this is
+cheap enough to leave on. Values are per process: with several gunicorn
+workers each scrape reflects the worker that answered it, identified by the
+`pid` label on every series.
+"""
+import bisect
+import hmac
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Distinct label sets kept per metric; anything beyond is folded into one overflow series
+MAX_SERIES = 500
+OVERFLOW = '__other__'
+
+# Evaluation criteria offered by the frontend. Criterion names come from the request body, so any
+# other value is recorded as 'other' rather than becoming a label value or a Server-Timing name.
+KNOWN_CRITERIA = frozenset(('groundedness', 'factual', 'completeness', 'relevance'))
+OTHER_CRITERION = 'other'
+
+_TIMING_NAME_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def criterion_label(criterion):
+    """`criterion` if it is one of KNOWN_CRITERIA, '' for none, otherwise 'other'"""
+    if not criterion:
+        return ''
+    return criterion if criterion in KNOWN_CRITERIA else OTHER_CRITERION
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        if key not in self._series and len(self._series) >= MAX_SERIES:
+            key = (OVERFLOW,) * len(self.labelnames)
+        return key
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._series.get(tuple(str(labels.get(name, '')) for name in self.labelnames), 0)
+
+    def render(self, extra):
+        lines = self.header()
+        with self._lock:
+            for key, value in self._series.items():
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key, extra)} {value}')
+        return lines
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def render(self, extra):
+        lines = self.header()
+        with self._lock:
+            for key, value in self._series.items():
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key, extra)} {value}')
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (non-cumulative, last slot is +Inf), sum, count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self, **labels):
+        """(count, sum) for one label set"""
+        series = self._series.get(tuple(str(labels.get(name, '')) for name in self.labelnames))
+        return (series[2], series[1]) if series else (0, 0.0)
+
+    def render(self, extra):
+        lines = self.header()
+        with self._lock:
+            items = [(key, list(series[0]), series[1], series[2]) for key, series in self._series.items()]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                labels = _format_labels(self.labelnames, key, list(extra) + [('le', le)])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key, extra)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._collectors = []
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def add_collector(self, collect):
+        """Register a callable run just before each render, e.g. to refresh gauges"""
+        self._collectors.append(collect)
+
+    def render(self):
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception:
+                logger.exception('Metrics collector failed')
+        extra = [('pid', os.getpid())]
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render(extra))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+REQUEST_SECONDS = registry.histogram(
+    'chat_eval_request_seconds', 'Request latency by route', ('route', 'method', 'status'))
+STAGE_SECONDS = registry.histogram(
+    'chat_eval_stage_seconds', 'Time spent in each stage of a request', ('route', 'stage', 'criterion'))
+
+
+def current_route():
+    """URL rule of the request being served ('unmatched' for 404s, '' outside a request)"""
+    if not has_request_context():
+        return ''
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@contextmanager
+def span(stage, criterion='', route=None):
+    """Time a block as one stage of the current request (or of `route`, e.g. a background job)"""
+    criterion = criterion_label(criterion)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, route=route or current_route(), stage=stage, criterion=criterion)
+        if has_request_context():
+            g.setdefault('spans', []).append((stage, criterion, elapsed))
+
+
+class _TimedSessionInterface:
+    """Wrap a session interface so session load and save show up as stages"""
+
+    def __init__(self, inner):
+        self._inner = inner
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+    def open_session(self, app, request):
+        # Runs before URL matching, so the stage is recorded in before_request
+        start = time.perf_counter()
+        g.request_started = start
+        try:
+            return self._inner.open_session(app, request)
+        finally:
+            g.session_load_seconds = time.perf_counter() - start
+
+    def save_session(self, app, session, response):
+        with span('session_save'):
+            return self._inner.save_session(app, session, response)
+
+
+def _server_timing(spans):
+    totals = {}
+    for stage, criterion, elapsed in spans:
+        name = f'{stage}.{criterion}' if criterion else stage
+        totals[name] = totals.get(name, 0.0) + elapsed
+    # Metric names must be HTTP tokens; stage names are ours, but keep the header valid whatever they hold
+    return ', '.join(f'{_TIMING_NAME_UNSAFE.sub("_", name)};dur={elapsed * 1000:.1f}'
+                     for name, elapsed in totals.items())
+
+
+def metrics_authorized():
+    """The request carries METRICS_TOKEN as a bearer token, or (with no token set) comes from localhost"""
+    token = os.environ.get('METRICS_TOKEN')
+    if not token:
+        return request.remote_addr in ('127.0.0.1', '::1')
+    scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip().encode(), token.encode())
+
+
+def init_metrics(app):
+    """Time every request, add a Server-Timing header and serve /metrics"""
+    app.session_interface = _TimedSessionInterface(app.session_interface)
+
+    @app.before_request
+    def _start_request_timer():
+        g.setdefault('request_started', time.perf_counter())
+        session_load = g.pop('session_load_seconds', None)
+        if session_load is not None:
+            STAGE_SECONDS.observe(session_load, route=current_route(), stage='session_load', criterion='')
+            g.setdefault('spans', []).append(('session_load', '', session_load))
+
+    @app.after_request
+    def _observe_request(response):
+        started = g.get('request_started')
+        if started is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route=current_route(),
+                                    method=request.method, status=response.status_code)
+        spans = g.get('spans')
+        if spans:
+            response.headers['Server-Timing'] = _server_timing(spans)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if not metrics_authorized():
+            return Response('Forbidden: send Authorization: Bearer <METRICS_TOKEN>\n', status=403,
+                            mimetype='text/plain')
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    return registry
@@ -0,0 +1,88 @@
+"""usage rollup table
+
+Revision ID: 40fcd67b96c1
+Revises: 70c276291507
+Create Date: 2026-10-19 13:39:28.195350
+
+"""
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '40fcd67b96c1'
+down_revision = '70c276291507'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    # A database started with db.create_all() may already have the (partially filled) table
+    if 'usage_rollup' not in sa.inspect(conn).get_table_names():
+        op.create_table('usage_rollup',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('action', sa.String(length=50), nullable=False),
+        sa.Column('messages', sa.Integer(), nullable=False),
+        sa.Column('evaluations', sa.Integer(), nullable=False),
+        sa.Column('tokens', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'day', 'action', name='uq_usage_rollup_user_day_action')
+        )
+
+    # Backfill from the detail rows, as `flask backfill-usage-rollups` does, so existing users keep their totals
+    chat_session = sa.table('chat_session', sa.column('id', sa.Integer), sa.column('user_id', sa.Integer))
+    message = sa.table('message', sa.column('id', sa.Integer), sa.column('session_id', sa.Integer),
+                       sa.column('timestamp', sa.DateTime))
+    evaluation = sa.table('evaluation', sa.column('id', sa.Integer), sa.column('session_id', sa.Integer),
+                          sa.column('timestamp', sa.DateTime))
+    usage_log = sa.table('usage_log', sa.column('user_id', sa.Integer), sa.column('action', sa.String),
+                         sa.column('tokens_used', sa.Integer), sa.column('timestamp', sa.DateTime))
+    usage_rollup = sa.table('usage_rollup', sa.column('user_id', sa.Integer), sa.column('day', sa.Date),
+                            sa.column('action', sa.String), sa.column('messages', sa.Integer),
+                            sa.column('evaluations', sa.Integer), sa.column('tokens', sa.Integer))
+
+    rollups = {}
+
+    def bucket(user_id, day, action):
+        day = date.fromisoformat(day) if isinstance(day, str) else day
+        return rollups.setdefault((user_id, day, action), {'messages': 0, 'evaluations': 0, 'tokens': 0})
+
+    for detail, field in ((message, 'messages'), (evaluation, 'evaluations')):
+        day = sa.func.date(detail.c.timestamp)
+        counts = conn.execute(
+            sa.select(chat_session.c.user_id, day, sa.func.count(detail.c.id))
+            .select_from(detail.join(chat_session, detail.c.session_id == chat_session.c.id))
+            .where(detail.c.timestamp.isnot(None))
+            .group_by(chat_session.c.user_id, day)
+        )
+        for user_id, day_value, count in counts:
+            bucket(user_id, day_value, 'chat')[field] += count
+
+    day = sa.func.date(usage_log.c.timestamp)
+    tokens = conn.execute(
+        sa.select(usage_log.c.user_id, day, usage_log.c.action,
+                  sa.func.coalesce(sa.func.sum(usage_log.c.tokens_used), 0))
+        .where(usage_log.c.timestamp.isnot(None))
+        .group_by(usage_log.c.user_id, day, usage_log.c.action)
+    )
+    for user_id, day_value, action, total in tokens:
+        bucket(user_id, day_value, action or 'chat')['tokens'] += total
+
+    conn.execute(sa.delete(usage_rollup))
+    if rollups:
+        conn.execute(sa.insert(usage_rollup), [
+            dict(counts, user_id=user_id, day=day_value, action=action)
+            for (user_id, day_value, action), counts in rollups.items()
+        ])
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_table('usage_rollup')
+    # ### end Alembic commands ###
@@ -0,0 +1,34 @@
+"""chat session and message indexes
+
+Revision ID: 781b73b7a60b
+Revises: 40fcd67b96c1
+Create Date: 2026-10-19 13:39:31.338925
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '781b73b7a60b'
+down_revision = '40fcd67b96c1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Build the indexes without blocking writes on Postgres (no-op elsewhere). IF NOT EXISTS because a
+    # database started with db.create_all() after the models gained them already has them.
+    with op.get_context().autocommit_block():
+        op.create_index('ix_chat_session_user_created', 'chat_session', ['user_id', 'created_at', 'id'],
+                        unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index(op.f('ix_message_session_id'), 'message', ['session_id'],
+                        unique=False, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_message_session_id'), table_name='message',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_chat_session_user_created', table_name='chat_session',
+                      postgresql_concurrently=True, if_exists=True)
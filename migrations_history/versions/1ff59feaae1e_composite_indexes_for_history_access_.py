@@ -0,0 +1,40 @@
+"""composite indexes for history access patterns
+
+Revision ID: 1ff59feaae1e
+Revises: 3ad79b54a466
+Create Date: 2026-10-19 13:02:11.723035
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1ff59feaae1e'
+down_revision = '3ad79b54a466'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Build the new indexes without blocking writes on Postgres (no-op elsewhere)
+    with op.get_context().autocommit_block():
+        op.create_index('ix_evaluation_history_session_timestamp', 'evaluation_history',
+                        ['session_id', sa.literal_column('timestamp DESC'), sa.literal_column('id DESC')],
+                        unique=False, postgresql_concurrently=True)
+        op.create_index('ix_evaluation_history_session_level_timestamp', 'evaluation_history',
+                        ['session_id', 'groundedness_level', 'timestamp'],
+                        unique=False, postgresql_concurrently=True)
+        # Redundant now: session_id is the leading column of both composite indexes
+        op.drop_index('ix_evaluation_history_session_id', table_name='evaluation_history',
+                      postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_evaluation_history_session_id', 'evaluation_history', ['session_id'],
+                        unique=False, postgresql_concurrently=True)
+        op.drop_index('ix_evaluation_history_session_level_timestamp', table_name='evaluation_history',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_evaluation_history_session_timestamp', table_name='evaluation_history',
+                      postgresql_concurrently=True)
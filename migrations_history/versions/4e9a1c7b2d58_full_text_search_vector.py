@@ -0,0 +1,41 @@
+"""full-text search vector and GIN index on Postgres
+
+Revision ID: 4e9a1c7b2d58
+Revises: 8c41d2e7a9b3
+Create Date: 2026-10-19 16:05:12.318407
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e9a1c7b2d58'
+down_revision = '8c41d2e7a9b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite's FTS5 table is created by history_search.install_search_index; only Postgres needs DDL here
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    # Adding a stored generated column rewrites the table, so it belongs in a deploy step, not a request
+    op.execute("""ALTER TABLE evaluation_history ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(question, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(response, '')), 'B')
+        ) STORED""")
+    with op.get_context().autocommit_block():
+        op.create_index('ix_evaluation_history_search_vector', 'evaluation_history', ['search_vector'],
+                        unique=False, postgresql_using='gin', postgresql_concurrently=True,
+                        if_not_exists=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_evaluation_history_search_vector', table_name='evaluation_history',
+                      postgresql_concurrently=True, if_exists=True)
+    op.drop_column('evaluation_history', 'search_vector')
@@ -0,0 +1,92 @@
+"""move document text into a content-addressed document table
+
+Revision ID: 8c41d2e7a9b3
+Revises: 1ff59feaae1e
+Create Date: 2026-10-19 14:20:37.518204
+
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c41d2e7a9b3'
+down_revision = '1ff59feaae1e'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.create_table('document',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('content_hash', sa.String(length=64), nullable=False),
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('content_hash')
+    )
+    conn = op.get_bind()
+    if conn.dialect.name == 'sqlite':
+        # SQLite can add a REFERENCES column in place; alembic's add_column would need a table copy
+        op.execute('ALTER TABLE evaluation_history ADD COLUMN document_id INTEGER REFERENCES document (id)')
+    else:
+        op.add_column('evaluation_history', sa.Column('document_id', sa.Integer(), nullable=True))
+        op.create_foreign_key('fk_evaluation_history_document_id', 'evaluation_history', 'document',
+                              ['document_id'], ['id'])
+    op.create_index(op.f('ix_evaluation_history_document_id'), 'evaluation_history', ['document_id'], unique=False)
+
+    # Backfill: one document per distinct excerpt, then point rows at it
+    history = sa.table('evaluation_history',
+                       sa.column('id', sa.Integer), sa.column('timestamp', sa.DateTime),
+                       sa.column('pdf_content', sa.Text), sa.column('document_id', sa.Integer))
+    document = sa.table('document',
+                        sa.column('id', sa.Integer), sa.column('content_hash', sa.String),
+                        sa.column('content', sa.Text), sa.column('created_at', sa.DateTime))
+    document_ids = {}
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(history.c.id, history.c.timestamp, history.c.pdf_content)
+            .where(history.c.id > last_id, history.c.pdf_content.isnot(None))
+            .order_by(history.c.id).limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        by_document = {}
+        for row_id, timestamp, content in rows:
+            content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+            if content_hash not in document_ids:
+                document_ids[content_hash] = conn.execute(
+                    document.insert().values(content_hash=content_hash, content=content, created_at=timestamp)
+                    .returning(document.c.id)
+                ).scalar_one()
+            by_document.setdefault(document_ids[content_hash], []).append(row_id)
+        for document_id, row_ids in by_document.items():
+            conn.execute(history.update().where(history.c.id.in_(row_ids)).values(document_id=document_id))
+        last_id = rows[-1][0]
+
+    # SQLite >= 3.35 drops the column in place, which keeps the FTS triggers intact
+    op.drop_column('evaluation_history', 'pdf_content')
+
+
+def downgrade():
+    op.add_column('evaluation_history', sa.Column('pdf_content', sa.Text(), nullable=True))
+    op.execute(
+        "UPDATE evaluation_history SET pdf_content = "
+        "(SELECT content FROM document WHERE document.id = evaluation_history.document_id) "
+        "WHERE document_id IS NOT NULL"
+    )
+    op.drop_index(op.f('ix_evaluation_history_document_id'), table_name='evaluation_history')
+    if op.get_bind().dialect.name == 'sqlite':
+        # SQLite cannot drop a REFERENCES column in place. The table copy loses the
+        # FTS sync triggers; install_search_index recreates them on next start.
+        with op.batch_alter_table('evaluation_history') as batch_op:
+            batch_op.drop_column('document_id')
+    else:
+        op.drop_constraint('fk_evaluation_history_document_id', 'evaluation_history', type_='foreignkey')
+        op.drop_column('evaluation_history', 'document_id')
+    op.drop_table('document')
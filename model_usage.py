@@ -0,0 +1,101 @@
+"""Token and cost accounting for Anthropic model calls.
+
+create_message() wraps client.messages.create: it times the call as a
+metrics span, reads input/output/cache token counts from response.usage,
+prices them with MODEL_PRICES and adds them to Prometheus counters. The
+per-call record is also appended to flask.g.model_calls so the route can
+persist it next to the turn it belongs to.
+"""
+import time
+
+from flask import g, has_request_context
+
+from metrics import criterion_label, registry, span
+
+# USD per million tokens
+MODEL_PRICES = {
+    'claude-3-haiku-20240307': {'input': 0.25, 'output': 1.25, 'cache_write': 0.30, 'cache_read': 0.03},
+    'claude-3-5-haiku-20241022': {'input': 0.80, 'output': 4.00, 'cache_write': 1.00, 'cache_read': 0.08},
+    'claude-3-5-sonnet-20241022': {'input': 3.00, 'output': 15.00, 'cache_write': 3.75, 'cache_read': 0.30},
+    'claude-3-opus-20240229': {'input': 15.00, 'output': 75.00, 'cache_write': 18.75, 'cache_read': 1.50}
+}
+
+TOKEN_KINDS = ('input', 'output', 'cache_write', 'cache_read')
+
+MODEL_TOKENS = registry.counter(
+    'chat_eval_model_tokens_total', 'Tokens used by model calls', ('model', 'stage', 'criterion', 'kind'))
+MODEL_COST = registry.counter(
+    'chat_eval_model_cost_usd_total', 'Estimated model spend in USD', ('model', 'stage', 'criterion'))
+MODEL_CALLS = registry.counter(
+    'chat_eval_model_calls_total', 'Model calls', ('model', 'stage', 'criterion', 'outcome'))
+
+
+def usage_tokens(usage):
+    """Token counts by kind from a response.usage object (missing fields count as 0)"""
+    return {
+        'input': getattr(usage, 'input_tokens', 0) or 0,
+        'output': getattr(usage, 'output_tokens', 0) or 0,
+        'cache_write': getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+        'cache_read': getattr(usage, 'cache_read_input_tokens', 0) or 0
+    }
+
+
+def cost_usd(model, tokens):
+    """Estimated cost of a call; 0 for models missing from MODEL_PRICES"""
+    prices = MODEL_PRICES.get(model)
+    if not prices:
+        return 0.0
+    return sum(tokens[kind] * prices[kind] for kind in TOKEN_KINDS) / 1_000_000
+
+
+def total_tokens(calls):
+    """Sum of all token kinds over a list of call records"""
+    return sum(call[f'{kind}_tokens'] for call in calls for kind in TOKEN_KINDS)
+
+
+def create_message(client, stage, criterion='', limiter=None, **kwargs):
+    """client.messages.create(**kwargs) with timing, token and cost accounting.
+
+    With an UpstreamLimiter the call is paced per API key and throttled or
+    transient failures are retried; the span then includes any waiting.
+    """
+    model = kwargs.get('model', '')
+    label = criterion_label(criterion)  # The per-call record keeps the name the user chose
+    start = time.perf_counter()
+    try:
+        with span(stage, criterion):
+            if limiter is not None:
+                response = limiter.call(client, lambda paced: paced.messages.create(**kwargs))
+            else:
+                response = client.messages.create(**kwargs)
+    except Exception:
+        MODEL_CALLS.inc(model=model, stage=stage, criterion=label, outcome='error')
+        raise
+    elapsed = time.perf_counter() - start
+
+    tokens = usage_tokens(getattr(response, 'usage', None))
+    cost = cost_usd(model, tokens)
+    MODEL_CALLS.inc(model=model, stage=stage, criterion=label, outcome='ok')
+    for kind, count in tokens.items():
+        if count:
+            MODEL_TOKENS.inc(count, model=model, stage=stage, criterion=label, kind=kind)
+    MODEL_COST.inc(cost, model=model, stage=stage, criterion=label)
+
+    call = {
+        'stage': stage,
+        'criterion': criterion or None,
+        'model': model,
+        'latency_ms': round(elapsed * 1000, 1),
+        'cost_usd': cost
+    }
+    call.update({f'{kind}_tokens': count for kind, count in tokens.items()})
+    if has_request_context():
+        g.setdefault('model_calls', []).append(call)
+    return response
+
+
+def request_model_calls():
+    """Call records collected so far in this request, clearing the list"""
+    if not has_request_context():
+        return []
+    return g.pop('model_calls', [])
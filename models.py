@@ -1,14 +1,47 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+import hashlib
 import json
+from sqlalchemy.exc import IntegrityError
+
+from evaluation_parser import parse_judge_output
 
 db = SQLAlchemy()
 
+class Document(db.Model):
+    """Document text shared by every history row that was answered from it"""
+    __tablename__ = 'document'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False, unique=True)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    @staticmethod
+    def hash_content(content):
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+    
+    @classmethod
+    def get_or_create(cls, content):
+        """Return the id of the document with this exact content, inserting it if new"""
+        content_hash = cls.hash_content(content)
+        document_id = db.session.query(cls.id).filter_by(content_hash=content_hash).scalar()
+        if document_id is not None:
+            return document_id
+        try:
+            with db.session.begin_nested():
+                document = cls(content_hash=content_hash, content=content)
+                db.session.add(document)
+            return document.id
+        except IntegrityError:
+            # Inserted concurrently by another request
+            return db.session.query(cls.id).filter_by(content_hash=content_hash).scalar()
+
 class EvaluationHistory(db.Model):
     __tablename__ = 'evaluation_history'
     
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.String(100), nullable=False, index=True)
+    session_id = db.Column(db.String(100), nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     
     question = db.Column(db.Text, nullable=False)
@@ -18,40 +51,44 @@ class EvaluationHistory(db.Model):
     groundedness_level = db.Column(db.String(50))
     evaluation_explanation = db.Column(db.Text)
     
-    pdf_content = db.Column(db.Text)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), index=True)
+    document = db.relationship('Document', lazy='select')
     pdf_filename = db.Column(db.String(255))
     
     improved_response = db.Column(db.Text)
     improved_evaluation = db.Column(db.Text)
     
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'session_id': self.session_id,
-            'timestamp': self.timestamp.isoformat(),
-            'question': self.question,
-            'response': self.response,
-            'evaluation': self.evaluation,
-            'groundedness_level': self.groundedness_level,
-            'evaluation_explanation': self.evaluation_explanation,
-            'pdf_filename': self.pdf_filename,
-            'improved_response': self.improved_response,
-            'improved_evaluation': self.improved_evaluation
-        }
+    # Fields serialized by to_dict, in output order
+    FIELDS = ('id', 'session_id', 'timestamp', 'question', 'response', 'evaluation',
+              'groundedness_level', 'evaluation_explanation', 'pdf_filename',
+              'improved_response', 'improved_evaluation')
+    
+    # Unbounded text columns; list views defer or truncate these
+    LARGE_FIELDS = ('question', 'response', 'evaluation', 'evaluation_explanation',
+                    'improved_response', 'improved_evaluation')
+    
+    @property
+    def pdf_content(self):
+        """Document excerpt this evaluation was answered from, if any"""
+        return self.document.content if self.document else None
+    
+    def to_dict(self, fields=None):
+        """Serialize the record, or only the given subset of FIELDS"""
+        data = {}
+        for field in fields or self.FIELDS:
+            value = getattr(self, field)
+            data[field] = value.isoformat() if field == 'timestamp' else value
+        return data
     
     @staticmethod
     def parse_evaluation(evaluation_text):
-        """Parse evaluation text to extract label and explanation"""
-        lines = evaluation_text.split('\n') if evaluation_text else []
-        label = ''
-        explanation = ''
-        
-        for line in lines:
-            if line.startswith('Label:'):
-                label = line.replace('Label:', '').strip()
-            elif line.startswith('Explanation:'):
-                explanation = line.replace('Explanation:', '').strip()
-            elif explanation and line.strip():
-                explanation += ' ' + line.strip()
-        
-        return label, explanation
\ No newline at end of file
+        """Parse judge output (JSON or "Label:"/"Explanation:" text) into label and explanation"""
+        return parse_judge_output(evaluation_text)
+
+# /history lists filter by session and page newest first; the stats and
+# groundedness filters add the level. Both indexes lead with session_id,
+# which also covers plain session lookups.
+db.Index('ix_evaluation_history_session_timestamp',
+         EvaluationHistory.session_id, EvaluationHistory.timestamp.desc(), EvaluationHistory.id.desc())
+db.Index('ix_evaluation_history_session_level_timestamp',
+         EvaluationHistory.session_id, EvaluationHistory.groundedness_level, EvaluationHistory.timestamp)
\ No newline at end of file
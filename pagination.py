@@ -0,0 +1,45 @@
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(timestamp, row_id):
+    """Opaque cursor pointing just past the row with this (timestamp, id)"""
+    raw = f"{timestamp.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError on a malformed cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, row_id = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def keyset_before(timestamp_column, id_column, timestamp, row_id):
+    """Filter for rows that come after (timestamp, id) in `timestamp DESC, id DESC` order"""
+    return or_(
+        timestamp_column < timestamp,
+        and_(timestamp_column == timestamp, id_column < row_id)
+    )
+
+
+def encode_offset_cursor(offset):
+    """Opaque cursor for result sets that can only be paged by position (e.g. ranked search)"""
+    return base64.urlsafe_b64encode(f"o|{offset}".encode()).decode().rstrip('=')
+
+
+def decode_offset_cursor(cursor):
+    """Inverse of encode_offset_cursor; raises ValueError on a malformed cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        kind, offset = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        if kind != 'o':
+            raise ValueError(kind)
+        return int(offset)
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
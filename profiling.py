@@ -0,0 +1,242 @@
+"""On-demand sampling profiler for individual requests.
+
+A request is profiled when it carries a valid signed header
+
+    X-Profile: <expires>:<hmac-sha256(PROFILE_SECRET, "<expires>:<path>")>
+
+(generate one with `python profiling.py sign /chat`), or when
+PROFILE_SAMPLE_RATE is set and the request is picked at random. Either way
+at most one request per process is profiled at a time, and no more than
+PROFILE_MAX_PER_MINUTE per process.
+
+While the request runs, a background thread samples its stack every
+PROFILE_INTERVAL_MS and counts identical stacks. When it finishes, two files
+named after the request id are written to PROFILE_DIR:
+
+    <time>-<request id>.folded   folded stacks, for flamegraph.pl / speedscope
+    <time>-<request id>.json     route, status, duration and the hottest functions
+
+and the response carries X-Profile-Id. Without PROFILE_SECRET and
+PROFILE_SAMPLE_RATE no hooks are installed at all.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, deque
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Profile'
+SIGNATURE_TTL = 300  # Seconds a freshly signed header stays valid
+_REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')  # Safe to use in a file name
+
+
+def sign(secret, path, ttl=SIGNATURE_TTL, now=None):
+    """Value for the X-Profile header that enables profiling of `path` for `ttl` seconds"""
+    expires = int((now or time.time()) + ttl)
+    signature = hmac.new(secret.encode(), f'{expires}:{path}'.encode(), hashlib.sha256).hexdigest()
+    return f'{expires}:{signature}'
+
+
+def verify(secret, path, value, now=None):
+    try:
+        expires, signature = value.split(':', 1)
+        if int(expires) < (now or time.time()):
+            return False
+    except ValueError:
+        return False
+    expected = hmac.new(secret.encode(), f'{expires}:{path}'.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+class StackSampler:
+    """Sample one thread's Python stack at a fixed interval from a background thread"""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[';'.join(stack)] += 1
+            self.samples += 1
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def hottest(self, limit=25):
+        """Functions by self samples (top of stack) and total samples (anywhere on the stack)"""
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            self_counts[frames[-1]] += count
+            for name in set(frames):
+                total_counts[name] += count
+        return {
+            'self': [{'function': name, 'samples': count} for name, count in self_counts.most_common(limit)],
+            'total': [{'function': name, 'samples': count} for name, count in total_counts.most_common(limit)]
+        }
+
+
+class RequestProfiler:
+    def __init__(self, secret=None, sample_rate=0.0, max_per_minute=6, interval=0.005, directory=None):
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.max_per_minute = max_per_minute
+        self.interval = interval
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'chateval_profiles')
+        self._lock = threading.Lock()
+        self._active = False
+        self._recent = deque()
+        self.profiles_written = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            secret=os.environ.get('PROFILE_SECRET') or None,
+            sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+            max_per_minute=int(os.environ.get('PROFILE_MAX_PER_MINUTE', 6)),
+            interval=float(os.environ.get('PROFILE_INTERVAL_MS', 5)) / 1000,
+            directory=os.environ.get('PROFILE_DIR') or None
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.secret) or self.sample_rate > 0
+
+    def _requested(self):
+        header = request.headers.get(PROFILE_HEADER)
+        if header and self.secret and verify(self.secret, request.path, header):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _acquire(self):
+        """Claim the per-process profiling slot if the rate limit allows"""
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            if self._active or len(self._recent) >= self.max_per_minute:
+                return False
+            self._active = True
+            self._recent.append(now)
+            return True
+
+    def _release(self):
+        with self._lock:
+            self._active = False
+
+    def start(self):
+        if not self._requested() or not self._acquire():
+            return
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        g.profile_sampler = sampler
+
+    def finish(self, response=None):
+        sampler = g.pop('profile_sampler', None)
+        if sampler is None:
+            return
+        try:
+            sampler.stop()
+            request_id = self.request_id()
+            self.write(sampler, request_id, response)
+            if response is not None:
+                response.headers['X-Profile-Id'] = request_id
+            logger.info('Request profile written', extra={'directory': self.directory, 'samples': sampler.samples})
+        except Exception:
+            logger.exception('Writing request profile failed')
+        finally:
+            self._release()
+
+    @staticmethod
+    def request_id():
+        request_id = g.get('request_id') or request.headers.get('X-Request-ID', '')
+        return request_id if _REQUEST_ID_RE.match(request_id) else uuid.uuid4().hex
+
+    def write(self, sampler, request_id, response):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{request_id}")
+        with open(f'{base}.folded', 'w') as f:
+            f.write(sampler.folded())
+        summary = {
+            'request_id': request_id,
+            'method': request.method,
+            'path': request.path,
+            'route': request.url_rule.rule if request.url_rule is not None else None,
+            'status': response.status_code if response is not None else None,
+            'duration_ms': round(sampler.elapsed * 1000, 1),
+            'interval_ms': self.interval * 1000,
+            'samples': sampler.samples,
+            'pid': os.getpid(),
+            'hottest': sampler.hottest()
+        }
+        with open(f'{base}.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        self.profiles_written += 1
+
+
+def init_profiling(app, profiler=None):
+    """Install the profiling hooks if profiling is configured; otherwise do nothing"""
+    profiler = profiler or RequestProfiler.from_env()
+    if not profiler.enabled:
+        return profiler
+
+    @app.before_request
+    def _start_profile():
+        profiler.start()
+
+    @app.after_request
+    def _finish_profile(response):
+        profiler.finish(response)
+        return response
+
+    @app.teardown_request
+    def _abandon_profile(exc):
+        # Only reached with a sampler still running if after_request never ran
+        profiler.finish()
+
+    return profiler
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'sign':
+        raise SystemExit('usage: PROFILE_SECRET=... python profiling.py sign <path>')
+    secret = os.environ.get('PROFILE_SECRET')
+    if not secret:
+        raise SystemExit('PROFILE_SECRET is not set')
+    print(f'{PROFILE_HEADER}: {sign(secret, sys.argv[2])}')
@@ -0,0 +1,153 @@
+"""Per-statement timing and per-request query counts from SQLAlchemy events.
+
+init_query_metrics(app, db) listens to the app's engine and, for every
+statement executed:
+
+- observes its duration in chat_eval_db_query_seconds, labelled with the
+  route and the statement's operation and main table
+- logs it as a slow query when it takes longer than DB_SLOW_QUERY_MS, with
+  the SQL text and the parameter types only (values are never logged)
+
+Within a request it also counts statements. At the end of the request the
+count goes to chat_eval_db_queries_per_request, the total time is added to
+the request's spans (so it shows in Server-Timing and the request log
+line), and a request that ran more than DB_QUERY_WARN_COUNT statements is
+logged as a likely N+1, listing the statements it repeated most.
+"""
+import logging
+import os
+import re
+import time
+from collections import Counter
+
+from flask import g, has_request_context
+from sqlalchemy import event
+
+from metrics import registry, current_route
+
+logger = logging.getLogger(__name__)
+
+QUERY_SECONDS = registry.histogram(
+    'chat_eval_db_query_seconds', 'SQL statement duration', ('route', 'operation', 'table'),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+QUERIES_PER_REQUEST = registry.histogram(
+    'chat_eval_db_queries_per_request', 'SQL statements executed per request', ('route',),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250))
+SLOW_QUERIES = registry.counter(
+    'chat_eval_db_slow_queries_total', 'SQL statements slower than DB_SLOW_QUERY_MS', ('route', 'operation', 'table'))
+QUERY_COUNT_WARNINGS = registry.counter(
+    'chat_eval_db_query_count_warnings_total', 'Requests that ran more than DB_QUERY_WARN_COUNT statements',
+    ('route',))
+
+_OPERATION_RE = re.compile(r'^\s*(?:WITH\b.*?\)\s*)?(\w+)', re.IGNORECASE | re.DOTALL)
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+["`\[]?(\w+)', re.IGNORECASE)
+_KNOWN_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT',
+                     'RELEASE', 'PRAGMA', 'CREATE', 'DROP', 'ALTER', 'VACUUM', 'ANALYZE'}
+_DML_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE'}
+
+
+def classify(statement):
+    """(operation, table) for a SQL statement, e.g. ('SELECT', 'evaluation_history')"""
+    match = _OPERATION_RE.match(statement)
+    operation = match.group(1).upper() if match else ''
+    if operation not in _KNOWN_OPERATIONS:
+        operation = 'OTHER'
+    if operation not in _DML_OPERATIONS:
+        return operation, ''
+    match = _TABLE_RE.search(statement)
+    return operation, match.group(1).lower() if match else ''
+
+
+def redact_parameters(parameters):
+    """Replace every bound value with its type name, keeping the shape of the parameters"""
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            # executemany: one parameter set per row
+            return {'rows': len(parameters), 'first': redact_parameters(parameters[0])}
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+class QueryMonitor:
+    def __init__(self, slow_ms=200.0, warn_count=20):
+        self.slow_seconds = slow_ms / 1000
+        self.warn_count = warn_count
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            slow_ms=float(os.environ.get('DB_SLOW_QUERY_MS', 200)),
+            warn_count=int(os.environ.get('DB_QUERY_WARN_COUNT', 20))
+        )
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _handle_error(self, exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('query_started'):
+            conn.info['query_started'].pop()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        operation, table = classify(statement)
+        route = current_route()
+        QUERY_SECONDS.observe(elapsed, route=route, operation=operation, table=table)
+
+        if elapsed >= self.slow_seconds:
+            SLOW_QUERIES.inc(route=route, operation=operation, table=table)
+            logger.warning('Slow query', extra={
+                'duration_ms': round(elapsed * 1000, 1),
+                'route': route,
+                'statement': statement[:2000],
+                'parameters': redact_parameters(parameters)
+            })
+
+        if has_request_context():
+            g.db_queries = g.get('db_queries', 0) + 1
+            g.db_query_seconds = g.get('db_query_seconds', 0.0) + elapsed
+            g.setdefault('db_statements', Counter())[statement] += 1
+
+    def finish_request(self):
+        count = g.pop('db_queries', 0)
+        seconds = g.pop('db_query_seconds', 0.0)
+        statements = g.pop('db_statements', None)
+        route = current_route()
+        QUERIES_PER_REQUEST.observe(count, route=route)
+        if count:
+            g.setdefault('spans', []).append(('db', '', seconds))
+            g.db_query_count = count
+        if count > self.warn_count:
+            QUERY_COUNT_WARNINGS.inc(route=route)
+            logger.warning('Request ran %d queries, possible N+1', count, extra={
+                'route': route,
+                'queries': count,
+                'db_ms': round(seconds * 1000, 1),
+                'repeated': [{'statement': statement[:300], 'count': n}
+                             for statement, n in statements.most_common(3) if n > 1]
+            })
+
+
+def init_query_metrics(app, db, monitor=None):
+    """Instrument the app's engine.
+
+    Call after init_metrics and init_request_logging, so the db span is
+    recorded before they build the Server-Timing header and the request log line.
+    """
+    monitor = monitor or QueryMonitor.from_env()
+    with app.app_context():
+        monitor.attach(db.engine)
+
+    @app.after_request
+    def _finish_query_metrics(response):
+        monitor.finish_request()
+        return response
+
+    return monitor
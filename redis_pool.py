@@ -0,0 +1,167 @@
+import logging
+import os
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Skip a failing dependency for a cool-down period after repeated errors.
+
+    closed    -> calls go through, consecutive failures are counted
+    open      -> calls are skipped until reset_timeout has elapsed
+    half_open -> one trial call is let through; success closes, failure re-opens
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self.total_failures = 0
+        self.times_opened = 0
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """Return True if a call should be attempted right now"""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self.total_failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    self.times_opened += 1
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def to_dict(self):
+        state = self.state
+        retry_in = None
+        if state == 'open':
+            retry_in = round(self.reset_timeout - (time.monotonic() - self._opened_at), 1)
+        return {
+            'state': state,
+            'consecutive_failures': self._failures,
+            'total_failures': self.total_failures,
+            'times_opened': self.times_opened,
+            'retry_in_seconds': retry_in
+        }
+
+
+class RedisPool:
+    """Lazily created, fork-safe Redis connection pool guarded by a circuit breaker.
+
+    Nothing connects at import time. The pool is built on first use in each
+    process, so gunicorn workers never inherit sockets from the master.
+    """
+
+    def __init__(self, url, connect_timeout=0.5, socket_timeout=0.5, max_connections=20,
+                 breaker=None):
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.socket_timeout = socket_timeout
+        self.max_connections = max_connections
+        self.breaker = breaker or CircuitBreaker()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._client = None
+        self._pid = None
+
+    @classmethod
+    def from_env(cls):
+        """Build a pool from REDIS_* environment variables"""
+        return cls(
+            os.environ.get('REDIS_URL', 'redis://localhost:6379'),
+            connect_timeout=float(os.environ.get('REDIS_CONNECT_TIMEOUT', 0.5)),
+            socket_timeout=float(os.environ.get('REDIS_SOCKET_TIMEOUT', 0.5)),
+            max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 20)),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.environ.get('REDIS_BREAKER_THRESHOLD', 3)),
+                reset_timeout=float(os.environ.get('REDIS_BREAKER_COOLDOWN', 30))
+            )
+        )
+
+    @property
+    def configured(self):
+        return bool(self.url)
+
+    def _get_client(self):
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    self._pool = redis.ConnectionPool.from_url(
+                        self.url,
+                        socket_connect_timeout=self.connect_timeout,
+                        socket_timeout=self.socket_timeout,
+                        max_connections=self.max_connections
+                    )
+                    self._client = redis.Redis(connection_pool=self._pool)
+                    self._pid = pid
+        return self._client
+
+    def run(self, fn, default=None):
+        """Call fn(client) unless the breaker is open.
+
+        Returns default when Redis is not configured, the breaker is open, or
+        the call fails with a Redis error.
+        """
+        if not self.configured or not self.breaker.allow():
+            return default
+        try:
+            result = fn(self._get_client())
+        except redis.RedisError as e:
+            self.breaker.record_failure()
+            logger.warning('Redis call failed, using fallback: %s', e,
+                           extra={'breaker': self.breaker.state})
+            return default
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def status(self):
+        """Ping Redis through the breaker and report the outcome"""
+        if not self.configured:
+            return 'not configured'
+        if self.breaker.state == 'open':
+            return 'circuit open'
+        return 'healthy' if self.run(lambda r: r.ping(), default=False) else 'unhealthy'
+
+    def pool_stats(self):
+        if self._pool is None or self._pid != os.getpid():
+            return {'created': False}
+        return {
+            'created': True,
+            'max_connections': self.max_connections,
+            'in_use': len(self._pool._in_use_connections),
+            'available': len(self._pool._available_connections)
+        }
@@ -0,0 +1,236 @@
+"""JSON logging through a background queue, with request ids and sampling.
+
+configure_logging() sends every log record to a bounded in-memory queue; a
+listener thread (one per process, started on first use so gunicorn workers
+get their own) formats the records as JSON lines and writes them to stderr.
+The request thread only copies the record and puts it on the queue, and a
+full queue drops records (counted in /metrics) instead of blocking.
+
+init_request_logging(app) gives every request an id (the incoming
+X-Request-ID header if it looks safe, otherwise a new one), echoes it in the
+X-Request-ID response header, attaches it to every record logged during the
+request, and ends each request with one summary line holding the route,
+status, duration and per-stage timings.
+
+Sampling is decided once per request, so a request is either logged
+completely or not at all: with LOG_SAMPLE_RATE=0.1 only one request in ten
+keeps its DEBUG/INFO records and summary line. Warnings and errors, and the
+summary of any request that failed or took longer than LOG_SLOW_MS, are
+always kept.
+
+Environment:
+    LOG_LEVEL        root level (default INFO)
+    LOG_LEVELS       per-logger overrides, e.g. "app=DEBUG,sqlalchemy.engine=WARNING"; httpx and
+                     httpcore default to WARNING, since httpx logs every model call at INFO
+    LOG_FORMAT       json (default) or text
+    LOG_SAMPLE_RATE  fraction of requests whose DEBUG/INFO records are kept (default 1)
+    LOG_SLOW_MS      requests slower than this are always logged (default 2000)
+    LOG_QUEUE_SIZE   records buffered before new ones are dropped (default 10000)
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+from metrics import registry
+
+LOG_RECORDS_DROPPED = registry.counter(
+    'chat_eval_log_records_dropped_total', 'Log records dropped because the log queue was full')
+
+_REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+# Attributes every LogRecord has; anything else was passed with extra= and is logged as a field
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_EXCEPTION_FORMATTER = logging.Formatter()
+
+request_logger = logging.getLogger('chat_eval.request')
+
+# Libraries whose INFO output is one line per outgoing HTTP request, outside any request's sampling
+DEFAULT_LOGGER_LEVELS = {'httpx': 'WARNING', 'httpcore': 'WARNING'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, including fields passed with extra="""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """Tag records with the current request id and apply the request's sampling decision"""
+
+    def filter(self, record):
+        if not has_request_context():
+            return True
+        if not hasattr(record, 'request_id'):
+            record.request_id = g.get('request_id')
+        return record.levelno >= logging.WARNING or g.get('log_sampled', True)
+
+
+class AsyncQueueHandler(QueueHandler):
+    """QueueHandler that never blocks and starts its listener lazily in each process"""
+
+    def __init__(self, handlers, maxsize=10000):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.handlers = handlers
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Records queued by the parent before the fork belong to the parent
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self._listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def prepare(self, record):
+        # Resolve the message and traceback here; JSON formatting happens on the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc()
+
+    def stop(self):
+        """Write out everything still queued and stop the listener thread"""
+        listener = self._listener
+        if listener is not None and self._pid == os.getpid():
+            self._listener = None
+            self._pid = None
+            listener.stop()
+
+
+def _parse_levels(spec):
+    levels = {}
+    for item in (spec or '').split(','):
+        name, _, level = item.strip().partition('=')
+        if name and level:
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """Route all logging through one AsyncQueueHandler on the root logger (idempotent)"""
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, AsyncQueueHandler):
+            return handler
+
+    output = logging.StreamHandler(sys.stderr)
+    if os.environ.get('LOG_FORMAT', 'json').lower() == 'text':
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s',
+                                              defaults={'request_id': '-'}))
+    else:
+        output.setFormatter(JsonFormatter())
+
+    handler = AsyncQueueHandler([output], maxsize=int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
+    handler.addFilter(RequestContextFilter())
+    root.addHandler(handler)
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    levels = dict(DEFAULT_LOGGER_LEVELS, **_parse_levels(os.environ.get('LOG_LEVELS')))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+    return handler
+
+
+def stop_logging():
+    """Flush queued records, e.g. from a gunicorn worker_exit hook"""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, AsyncQueueHandler):
+            handler.stop()
+
+
+def _stage_durations(spans):
+    stages = {}
+    for stage, criterion, elapsed in spans:
+        name = f'{stage}.{criterion}' if criterion else stage
+        stages[name] = round(stages.get(name, 0.0) + elapsed * 1000, 1)
+    return stages
+
+
+def init_request_logging(app, sample_rate=None, slow_ms=None):
+    """Assign request ids and log one sampled summary line per request"""
+    if sample_rate is None:
+        sample_rate = float(os.environ.get('LOG_SAMPLE_RATE', 1))
+    if slow_ms is None:
+        slow_ms = float(os.environ.get('LOG_SLOW_MS', 2000))
+
+    @app.before_request
+    def _assign_request_id():
+        incoming = request.headers.get('X-Request-ID', '')
+        g.request_id = incoming if _REQUEST_ID_RE.match(incoming) else uuid.uuid4().hex
+        g.log_sampled = sample_rate >= 1 or random.random() < sample_rate
+        g.setdefault('request_started', time.perf_counter())
+
+    @app.after_request
+    def _log_request(response):
+        request_id = g.get('request_id')
+        if request_id is None:
+            return response
+        response.headers['X-Request-ID'] = request_id
+        duration_ms = (time.perf_counter() - g.request_started) * 1000
+        if response.status_code >= 500 or duration_ms >= slow_ms:
+            level = logging.WARNING
+        elif g.log_sampled:
+            level = logging.INFO
+        else:
+            return response
+        if request_logger.isEnabledFor(level):
+            request_logger.log(level, 'request', extra={
+                'method': request.method,
+                'path': request.path,
+                'route': request.url_rule.rule if request.url_rule is not None else None,
+                'status': response.status_code,
+                'duration_ms': round(duration_ms, 1),
+                'stages': _stage_durations(g.get('spans', ())),
+                'db_queries': g.get('db_query_count', 0)
+            })
+        return response
+
+    return app
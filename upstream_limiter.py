@@ -0,0 +1,327 @@
+"""Pacing of Anthropic calls per API key: token bucket plus AIMD concurrency.
+
+Before each call UpstreamLimiter.call() takes a lease on one of the API
+key's concurrency slots and, if UPSTREAM_RATE is set, a token from its
+bucket (UPSTREAM_RATE per second, bursts of UPSTREAM_BURST). The bucket is
+off by default: the key's real limits depend on its Anthropic tier, so the
+limiter learns them from 429/529 responses instead of guessing a rate that
+would hold everyone sharing the key back. The number of slots adapts (AIMD):
+
+- every successful call raises the limit by 1/limit, i.e. about one extra
+  slot per round of calls
+- a 429 or 529 (overloaded) response halves it, down to UPSTREAM_MIN_CONCURRENCY,
+  and blocks the key until its retry-after has passed
+
+A throttled, overloaded or transiently failing call is retried (up to
+UPSTREAM_MAX_ATTEMPTS) once the limiter lets it through again, instead of
+surfacing as an error. If a call cannot start within UPSTREAM_MAX_WAIT
+seconds, UpstreamBusy is raised so the route can answer 429 with a
+Retry-After header.
+
+The state lives in Redis (two Lua scripts keep each step atomic), so all
+workers share one bucket and one limit per key. Leases expire on their own,
+so a worker killed mid-call cannot leak a slot. Without Redis (or while its
+circuit breaker is open) each worker falls back to the same algorithm in
+memory. Keys are stored as fingerprints, never as the API key itself.
+"""
+import hashlib
+import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import anthropic
+
+from metrics import registry, span
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_WAIT_SECONDS = registry.histogram(
+    'chat_eval_upstream_wait_seconds', 'Time model calls waited for a token or a concurrency slot', (),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+UPSTREAM_RETRIES = registry.counter(
+    'chat_eval_upstream_retries_total', 'Model calls retried by the limiter', ('reason',))
+UPSTREAM_REJECTED = registry.counter(
+    'chat_eval_upstream_rejected_total', 'Model calls given up on after UPSTREAM_MAX_WAIT or UPSTREAM_MAX_ATTEMPTS')
+
+# Statuses that mean "slow down": the limit is cut and retry-after honoured
+THROTTLE_STATUSES = (429, 529)
+# Statuses worth retrying after a short backoff, without touching the limit
+TRANSIENT_STATUSES = (500, 502, 503, 504)
+
+FULL = -1  # acquire() result when every concurrency slot is taken
+
+# KEYS: bucket, leases, state
+# ARGV: now_ms, rate_per_s (0: no token bucket), burst, lease_id, lease_ttl_ms, initial_limit, key_ttl_s
+# Returns 0 once a token and a slot are taken, the ms to wait for either, or -1 if all slots are busy
+ACQUIRE_LUA = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[3], 'limit', 'blocked_until')
+local limit = tonumber(state[1]) or tonumber(ARGV[6])
+local blocked_until = tonumber(state[2]) or 0
+if blocked_until > now then
+  return math.ceil(blocked_until - now)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZCARD', KEYS[2]) >= math.floor(limit) then
+  return -1
+end
+if rate > 0 then
+  local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+  local tokens = tonumber(bucket[1]) or burst
+  local ts = tonumber(bucket[2]) or now
+  tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate / 1000)
+  if tokens < 1 then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], ARGV[7])
+    return math.max(math.ceil((1 - tokens) * 1000 / rate), 1)
+  end
+  redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'ts', tostring(now))
+  redis.call('EXPIRE', KEYS[1], ARGV[7])
+end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[5]), ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[7])
+return 0
+"""
+
+# KEYS: leases, state
+# ARGV: lease_id, outcome, now_ms, retry_after_ms, initial_limit, min_limit, max_limit, key_ttl_s
+# Returns the new limit as a string
+RELEASE_LUA = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[2], 'limit', 'blocked_until')
+local limit = tonumber(state[1]) or tonumber(ARGV[5])
+local blocked_until = tonumber(state[2]) or 0
+if ARGV[2] == 'ok' then
+  limit = math.min(tonumber(ARGV[7]), limit + 1 / limit)
+elseif ARGV[2] == 'throttled' then
+  if blocked_until <= now then
+    -- Only the first throttle of a burst cuts the limit; the rest land in the same cooldown
+    limit = math.max(tonumber(ARGV[6]), limit / 2)
+  end
+  blocked_until = math.max(blocked_until, now + tonumber(ARGV[4]))
+end
+redis.call('HSET', KEYS[2], 'limit', tostring(limit), 'blocked_until', tostring(blocked_until))
+redis.call('EXPIRE', KEYS[2], ARGV[8])
+return tostring(limit)
+"""
+
+
+class UpstreamBusy(Exception):
+    """A model call could not be made in time; the client should retry after `retry_after` seconds"""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def key_fingerprint(api_key):
+    return hashlib.sha256((api_key or '').encode()).hexdigest()[:16]
+
+
+def classify_error(error):
+    """('throttled' | 'transient' | 'fatal', retry_after seconds or None) for an exception from the SDK"""
+    if isinstance(error, anthropic.APIStatusError):
+        retry_after = None
+        headers = error.response.headers if error.response is not None else {}
+        try:
+            if headers.get('retry-after-ms'):
+                retry_after = float(headers['retry-after-ms']) / 1000
+            elif headers.get('retry-after'):
+                retry_after = float(headers['retry-after'])
+        except ValueError:
+            pass
+        if error.status_code in THROTTLE_STATUSES:
+            return 'throttled', retry_after
+        if error.status_code in TRANSIENT_STATUSES:
+            return 'transient', retry_after
+        return 'fatal', None
+    if isinstance(error, anthropic.APIConnectionError):
+        return 'transient', None
+    return 'fatal', None
+
+
+class LocalLimiterState:
+    """In-process version of the Redis scripts, used when Redis is unavailable"""
+
+    def __init__(self, max_keys=1024):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._keys = OrderedDict()
+
+    def _entry(self, key, now, burst, initial_limit):
+        entry = self._keys.get(key)
+        if entry is None:
+            entry = {'tokens': burst, 'ts': now, 'leases': {}, 'limit': initial_limit, 'blocked_until': 0}
+            self._keys[key] = entry
+            if len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        else:
+            self._keys.move_to_end(key)
+        return entry
+
+    def acquire(self, key, now, rate, burst, lease_id, lease_ttl, initial_limit):
+        with self._lock:
+            entry = self._entry(key, now, burst, initial_limit)
+            if entry['blocked_until'] > now:
+                return math.ceil(entry['blocked_until'] - now)
+            entry['leases'] = {lease: expiry for lease, expiry in entry['leases'].items() if expiry > now}
+            if len(entry['leases']) >= math.floor(entry['limit']):
+                return FULL
+            if rate > 0:
+                tokens = min(burst, entry['tokens'] + max(now - entry['ts'], 0) * rate / 1000)
+                entry['ts'] = now
+                if tokens < 1:
+                    entry['tokens'] = tokens
+                    return max(math.ceil((1 - tokens) * 1000 / rate), 1)
+                entry['tokens'] = tokens - 1
+            entry['leases'][lease_id] = now + lease_ttl
+            return 0
+
+    def release(self, key, lease_id, outcome, now, retry_after_ms, initial_limit, min_limit, max_limit):
+        with self._lock:
+            entry = self._entry(key, now, 0, initial_limit)
+            entry['leases'].pop(lease_id, None)
+            if outcome == 'ok':
+                entry['limit'] = min(max_limit, entry['limit'] + 1 / entry['limit'])
+            elif outcome == 'throttled':
+                if entry['blocked_until'] <= now:
+                    entry['limit'] = max(min_limit, entry['limit'] / 2)
+                entry['blocked_until'] = max(entry['blocked_until'], now + retry_after_ms)
+            return entry['limit']
+
+
+class UpstreamLimiter:
+    def __init__(self, redis_pool=None, rate=0.0, burst=20, initial_concurrency=8, min_concurrency=1,
+                 max_concurrency=64, max_wait=30.0, max_attempts=4, call_timeout=120.0):
+        self.redis_pool = redis_pool
+        self.rate = rate
+        self.burst = burst
+        self.initial_concurrency = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.lease_ttl_ms = int(call_timeout * 1000)
+        self.key_ttl = max(int(call_timeout) * 2, 3600)
+        self.local = LocalLimiterState()
+        self._scripts = None
+
+    @classmethod
+    def from_env(cls, redis_pool=None):
+        return cls(
+            redis_pool,
+            rate=float(os.environ.get('UPSTREAM_RATE', 0)),
+            burst=int(os.environ.get('UPSTREAM_BURST', 20)),
+            initial_concurrency=float(os.environ.get('UPSTREAM_CONCURRENCY', 8)),
+            min_concurrency=float(os.environ.get('UPSTREAM_MIN_CONCURRENCY', 1)),
+            max_concurrency=float(os.environ.get('UPSTREAM_MAX_CONCURRENCY', 64)),
+            max_wait=float(os.environ.get('UPSTREAM_MAX_WAIT', 30)),
+            max_attempts=int(os.environ.get('UPSTREAM_MAX_ATTEMPTS', 4))
+        )
+
+    def _redis_scripts(self, client):
+        if self._scripts is None:
+            self._scripts = (client.register_script(ACQUIRE_LUA), client.register_script(RELEASE_LUA))
+        return self._scripts
+
+    @staticmethod
+    def _keys(key):
+        prefix = f'upstream:{key}'
+        return f'{prefix}:bucket', f'{prefix}:leases', f'{prefix}:state'
+
+    def _try_acquire(self, key, lease_id):
+        """0 when a token and slot were taken, otherwise the ms to wait (FULL: poll shortly)"""
+        now = int(time.time() * 1000)
+        if self.redis_pool is not None:
+            bucket, leases, state = self._keys(key)
+            result = self.redis_pool.run(lambda r: self._redis_scripts(r)[0](
+                keys=[bucket, leases, state],
+                args=[now, self.rate, self.burst, lease_id, self.lease_ttl_ms, self.initial_concurrency,
+                      self.key_ttl],
+                client=r))
+            if result is not None:
+                return int(result)
+        return self.local.acquire(key, now, self.rate, self.burst, lease_id, self.lease_ttl_ms,
+                                  self.initial_concurrency)
+
+    def _release(self, key, lease_id, outcome, retry_after):
+        now = int(time.time() * 1000)
+        retry_after_ms = int((retry_after or 1.0) * 1000)
+        limit = None
+        if self.redis_pool is not None:
+            _, leases, state = self._keys(key)
+            limit = self.redis_pool.run(lambda r: self._redis_scripts(r)[1](
+                keys=[leases, state],
+                args=[lease_id, outcome, now, retry_after_ms, self.initial_concurrency, self.min_concurrency,
+                      self.max_concurrency, self.key_ttl],
+                client=r))
+        if limit is None:
+            limit = self.local.release(key, lease_id, outcome, now, retry_after_ms, self.initial_concurrency,
+                                       self.min_concurrency, self.max_concurrency)
+        if outcome == 'throttled':
+            logger.warning('Upstream throttled, concurrency limit now %s', limit,
+                           extra={'user_key': key, 'retry_after': retry_after})
+
+    def _acquire(self, key, deadline):
+        lease_id = uuid.uuid4().hex
+        started = time.monotonic()
+        while True:
+            wait_ms = self._try_acquire(key, lease_id)
+            if wait_ms == 0:
+                waited = time.monotonic() - started
+                UPSTREAM_WAIT_SECONDS.observe(waited)
+                return lease_id
+            if wait_ms == FULL:
+                wait_ms = 50
+            wait = wait_ms / 1000 * random.uniform(1.0, 1.2)  # Jitter so waiting workers don't wake together
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                UPSTREAM_REJECTED.inc()
+                raise UpstreamBusy(max(wait, 1.0), 'Too many requests to the model for this API key')
+            time.sleep(wait)
+
+    def call(self, client, fn):
+        """fn(client) paced for client's API key, retrying throttled and transient failures.
+
+        The SDK's own retries are turned off for these calls so every 429 is
+        seen, and acted on, by the shared limiter.
+        """
+        key = key_fingerprint(client.api_key)
+        client = client.with_options(max_retries=0)
+        deadline = time.monotonic() + self.max_wait
+        attempt = 1
+        while True:
+            with span('upstream_wait'):
+                lease_id = self._acquire(key, deadline)
+            try:
+                result = fn(client)
+            except Exception as e:
+                outcome, retry_after = classify_error(e)
+                self._release(key, lease_id, 'throttled' if outcome == 'throttled' else 'error', retry_after)
+                if outcome == 'fatal':
+                    raise
+                if attempt >= self.max_attempts:
+                    UPSTREAM_REJECTED.inc()
+                    if outcome == 'throttled':
+                        raise UpstreamBusy(retry_after or 1.0, 'The model is rate limiting this API key') from e
+                    raise
+                UPSTREAM_RETRIES.inc(reason=outcome)
+                if outcome == 'transient':
+                    # The limiter doesn't block on transient errors, so back off here
+                    backoff = min(retry_after or 0.5 * 2 ** (attempt - 1), 8.0) * random.uniform(0.8, 1.2)
+                    if time.monotonic() + backoff > deadline:
+                        raise
+                    time.sleep(backoff)
+                attempt += 1
+                continue
+            self._release(key, lease_id, 'ok', None)
+            return result
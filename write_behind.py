@@ -0,0 +1,161 @@
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+RECORDS_DROPPED = registry.counter(
+    'chat_eval_write_behind_dropped_total', 'Records the write-behind queue gave up on', ('reason',))
+
+
+class WriteBehindQueue:
+    """Buffer records in memory and hand them to a flush function in batches.
+
+    Records are flushed from a background thread when `batch_size` records are
+    waiting or `flush_interval` seconds have passed, whichever comes first, so
+    the request that produced them never waits on the database. The thread is
+    started lazily in each process (after gunicorn forks) and `close()` drains
+    whatever is left on shutdown.
+
+    When `flush_fn` raises, the batch's records are held back and retried
+    with a later batch once `flush_interval * 2**attempts` seconds have
+    passed (4, then 8 seconds with the defaults), so the retries span a
+    short database outage instead of failing within milliseconds. After
+    `max_attempts` failed flushes a record is dropped and counted in
+    `dropped` and in /metrics.
+    """
+
+    def __init__(self, flush_fn, batch_size=50, flush_interval=2.0, max_size=10000, max_attempts=3):
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        # (ready_at, sequence, attempts, record) waiting out their backoff; only the writer thread touches it
+        self._retries = []
+        self._sequence = itertools.count()
+        self.enqueued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.failed_batches = 0
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                # A forked child inherits the parent's buffered records; they
+                # belong to the parent, which flushes them itself.
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._retries = []
+                self._stopping = threading.Event()
+                atexit.register(self.close)
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def put(self, record):
+        """Queue a record for persistence; never blocks the caller"""
+        self._ensure_started()
+        try:
+            # Records travel with the number of failed flushes they have been part of
+            self._queue.put_nowait((record, 0))
+            self.enqueued += 1
+        except queue.Full:
+            self._drop(1, 'queue_full')
+            logger.warning('Write-behind queue full, dropped record', extra={'dropped_total': self.dropped})
+
+    def _drop(self, count, reason):
+        self.dropped += count
+        RECORDS_DROPPED.inc(count, reason=reason)
+
+    def _due_retries(self, limit, now=None):
+        """Held-back records whose backoff has expired (all of them when now is None)"""
+        batch = []
+        while self._retries and len(batch) < limit and (now is None or self._retries[0][0] <= now):
+            _, _, attempts, record = heapq.heappop(self._retries)
+            batch.append((record, attempts))
+        return batch
+
+    def _drain(self):
+        batch = self._due_retries(self.batch_size)
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch, retry=True):
+        if not batch:
+            return
+        try:
+            self.flush_fn([record for record, _ in batch])
+            self.flushed += len(batch)
+        except Exception:
+            self.failed_batches += 1
+            held = [(record, attempts + 1) for record, attempts in batch
+                    if retry and attempts + 1 < self.max_attempts]
+            given_up = len(batch) - len(held)
+            logger.exception('Write-behind flush failed', extra={
+                'records': len(batch), 'requeued': len(held), 'dropped': given_up})
+            if given_up:
+                self._drop(given_up, 'flush_failed')
+            now = time.monotonic()
+            for record, attempts in held:
+                ready_at = now + self.flush_interval * 2 ** attempts
+                heapq.heappush(self._retries, (ready_at, next(self._sequence), attempts, record))
+            self.retried += len(held)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            deadline = time.monotonic() + self.flush_interval
+            batch = self._due_retries(self.batch_size, now=time.monotonic())
+            while len(batch) < self.batch_size and not self._stopping.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    # Wake up at least every half second to notice close()
+                    batch.append(self._queue.get(timeout=min(remaining, 0.5)))
+                except queue.Empty:
+                    continue
+            self._flush(batch)
+        # Final drain on shutdown: held-back records get one last try without waiting out their backoff
+        while True:
+            batch = self._drain()
+            if not batch:
+                break
+            self._flush(batch, retry=False)
+
+    def close(self, timeout=10.0):
+        """Stop the background thread after flushing everything queued"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            'pending': self._queue.qsize() + len(self._retries),
+            'enqueued': self.enqueued,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'retried': self.retried,
+            'failed_batches': self.failed_batches
+        }